@@ -0,0 +1,161 @@
+# bench/coldstart.py — time-to-first-response of a fresh bot_pro process
+#
+#   python bench/coldstart.py                          # lazy vs eager, /help, 5 runs each
+#   python bench/coldstart.py --command search --arg "2+2" --server flask --runs 10
+#   python bench/coldstart.py --importtime             # + top modules from `python -X importtime`
+#
+# Every run spawns a new interpreter (a cold start), imports bot_pro, posts one
+# webhook update the way a serverless invocation would (no lifespan/warm-up) and
+# stops the clock when the fake Telegram API receives the first reply. Runs with
+# LAZY_STARTUP=1 and LAZY_STARTUP=0 so the two startup modes can be compared.
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import subprocess
+import statistics
+from types import SimpleNamespace
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+from loadtest import _asgi_post, configure_env, control, free_port, make_updates  # noqa: E402
+
+HEAVY_MODULES = ("numexpr", "numpy", "flask", "telegram.ext", "firebase_admin")
+
+def child(args):
+    """One cold start; prints a JSON line with timings relative to process spawn."""
+    t0 = float(os.environ["COLDSTART_T0"])
+    fake_base = os.environ["TELEGRAM_API_BASE"]
+    sys.path.insert(0, ROOT)
+    import bot_pro
+    imported = time.time() - t0
+    update = make_updates(1, {"quota": 1}, 1, 1.0, 1)[0]
+    update["message"]["text"] = f"/{args.command} {args.arg}".strip()
+    update["message"]["entities"][0]["length"] = len(args.command) + 1
+    chat = update["message"]["chat"]["id"]
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        if args.server == "flask":
+            client = bot_pro.app.test_client()
+            resp = await loop.run_in_executor(None, lambda: client.post(f"/{bot_pro.BOT_SECRET}", json=update))
+            status = resp.status_code
+        else:
+            status = await _asgi_post(bot_pro.asgi_app, f"/{bot_pro.BOT_SECRET}", json.dumps(update).encode())
+        acked = time.time() - t0
+        first = None
+        deadline = time.time() + 30
+        while first is None and time.time() < deadline:
+            stats = await loop.run_in_executor(None, control, fake_base, "/__stats")
+            times = [t for t, method, c in stats["events"] if c == chat]
+            if times:
+                first = min(times) - t0
+            else:
+                await asyncio.sleep(0.005)
+        return status, acked, first
+
+    status, acked, first = asyncio.run(run())
+    print(json.dumps({
+        "status": status, "import_s": round(imported, 4), "ack_s": round(acked, 4),
+        "first_response_s": None if first is None else round(first, 4),
+        "loaded": [m for m in HEAVY_MODULES if m in sys.modules],
+    }))
+    sys.stdout.flush()
+    os._exit(0)   # skip interpreter teardown; only the cold path is measured
+
+def importtime_report(top: int):
+    """Top `top` modules by cumulative import time for a bare `import bot_pro`."""
+    proc = subprocess.run([sys.executable, "-X", "importtime", "-c", "import bot_pro"], cwd=ROOT,
+                          capture_output=True, text=True)
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        parts = line[len("import time:"):].split("|")
+        try:
+            self_us, cum_us = int(parts[0]), int(parts[1])
+        except ValueError:
+            continue
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        rows.append((cum_us, self_us, depth, name.strip()))
+    total = next((r for r in rows if r[3] == "bot_pro"), None)
+    top_level = sorted((r for r in rows if r[2] <= 1 and r[3] != "bot_pro"), reverse=True)[:top]
+    return {
+        "total_ms": round(total[0] / 1000, 1) if total else None,
+        "bot_pro_self_ms": round(total[1] / 1000, 1) if total else None,
+        "top": [{"module": name, "cumulative_ms": round(cum / 1000, 1)} for cum, _, _, name in top_level],
+    }
+
+def summarize(samples):
+    out = {"runs": len(samples)}
+    for key in ("import_s", "ack_s", "first_response_s"):
+        values = [s[key] for s in samples if s[key] is not None]
+        if values:
+            out[f"{key[:-2]}_p50_ms"] = round(statistics.median(values) * 1000, 1)
+            out[f"{key[:-2]}_max_ms"] = round(max(values) * 1000, 1)
+    out["unanswered"] = sum(1 for s in samples if s["first_response_s"] is None)
+    out["loaded"] = samples[-1]["loaded"] if samples else []
+    return out
+
+def main():
+    ap = argparse.ArgumentParser(description="Measure bot_pro cold-start time-to-first-response")
+    ap.add_argument("--command", default="help", choices=("help", "search", "quota", "ask"))
+    ap.add_argument("--arg", default="", help="command argument, e.g. '2+2' for --command search")
+    ap.add_argument("--server", choices=("asgi", "flask"), default="asgi")
+    ap.add_argument("--runs", type=int, default=5)
+    ap.add_argument("--modes", default="lazy,eager")
+    ap.add_argument("--backend", choices=("sqlite", "firebase"), default="sqlite")
+    ap.add_argument("--importtime", action="store_true", help="add a -X importtime report per mode")
+    ap.add_argument("--top", type=int, default=12)
+    ap.add_argument("--out", help="also write the JSON report here")
+    ap.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    if args.child:
+        return child(args)
+
+    port = free_port()
+    fake_base = f"http://127.0.0.1:{port}"
+    fake = subprocess.Popen([sys.executable, os.path.join(HERE, "fakes.py"), "--port", str(port)])
+    report = {"config": {k: getattr(args, k) for k in ("command", "arg", "server", "runs", "backend")}}
+    try:
+        for _ in range(100):
+            try:
+                control(fake_base, "/__stats")
+                break
+            except OSError:
+                time.sleep(0.1)
+        configure_env(SimpleNamespace(backend=args.backend), fake_base)
+        for mode in args.modes.split(","):
+            env = dict(os.environ, LAZY_STARTUP="1" if mode == "lazy" else "0")
+            samples = []
+            for _ in range(args.runs):
+                control(fake_base, "/__reset", {})
+                env["COLDSTART_T0"] = repr(time.time())
+                proc = subprocess.run([sys.executable, __file__, "--child", "--command", args.command,
+                                       "--arg", args.arg, "--server", args.server],
+                                      env=env, capture_output=True, text=True, timeout=120)
+                lines = [l for l in proc.stdout.splitlines() if l.startswith("{")]
+                if proc.returncode or not lines:
+                    sys.stderr.write(proc.stderr)
+                    raise SystemExit(f"cold-start child failed ({mode})")
+                samples.append(json.loads(lines[-1]))
+            report[mode] = summarize(samples)
+            if args.importtime:
+                os.environ["LAZY_STARTUP"] = env["LAZY_STARTUP"]
+                report[mode]["importtime"] = importtime_report(args.top)
+    finally:
+        fake.terminate()
+        fake.wait()
+
+    print(json.dumps(report, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+# bench/fakes.py — local stand-ins for Telegram Bot API, Gemini, Vertex, Custom Search and Firebase RTDB
+#
+# One asyncio HTTP/1.1 server (keep-alive aware) answers every upstream the bot
+# talks to, routed by path:
+#   /bot<token>/<method>                      Telegram Bot API
+#   /v1beta/models/<model>:generateContent    Gemini (and :streamGenerateContent, SSE)
+#   /v1/projects/.../imagegeneration:predict  Vertex image generation
+#   /customsearch/v1                          Google Custom Search
+#   /fb/<path>.json                           Firebase RTDB REST (GET/PUT/PATCH, .sv increment)
+# Control endpoints for the load driver:
+#   GET /__stats     call counts per upstream + Telegram send events
+#   POST /__reset    clear counters/events
+#   POST /__updates  queue raw Telegram updates for getUpdates (polling mode)
+#
+# Run standalone: python bench/fakes.py --port 8089 --latency vertex=3,gemini=0.8 --errors vertex=0.05
+# --flood chat=1,global=30 makes the fake Telegram enforce per-chat / global
+# sends-per-second limits with 429 + retry_after, like the real Bot API.
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import struct
+import base64
+import asyncio
+import argparse
+import contextlib
+from collections import deque
+from urllib.parse import urlsplit, parse_qs
+
+UPSTREAMS = ("telegram", "gemini", "vertex", "search", "firebase")
+DEFAULT_LATENCY = {"telegram": 0.03, "gemini": 0.8, "vertex": 3.0, "search": 0.3, "firebase": 0.05}
+
+def parse_kv(spec: str, cast=float):
+    """"vertex=3,gemini=0.5" -> {"vertex": 3.0, "gemini": 0.5}"""
+    out = {}
+    for part in (spec or "").split(","):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            out[k.strip()] = cast(v)
+    return out
+
+def make_png(size: int, seed: int = 0):
+    """Valid RGB PNG of random noise (so byte sizes look like real generations)."""
+    rnd = random.Random(seed)
+    raw = b"".join(b"\x00" + rnd.randbytes(size * 3) for _ in range(size))
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    ihdr = struct.pack(">IIBBBBB", size, size, 8, 2, 0, 0, 0)
+    return b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", ihdr) + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b"")
+
+class FakeUpstreams:
+    def __init__(self, latency: dict, errors: dict, image_size: int = 256, answer_words: int = 120,
+                 flood: dict = None):
+        self.latency = {**DEFAULT_LATENCY, **latency}
+        self.errors = errors
+        self.flood = flood or {}
+        self.answer_words = answer_words
+        self.image_b64 = base64.b64encode(make_png(image_size)).decode()
+        self.reset()
+
+    def reset(self):
+        self.calls = {u: 0 for u in UPSTREAMS}
+        self.failures = {u: 0 for u in UPSTREAMS}
+        self.events = []            # (t, method, chat_id) for every Telegram send/edit
+        self.flooded = 0            # 429s from the --flood limits
+        self._recent = {}           # chat_id (None = global) -> send times in the last second
+        self.updates = []           # queued updates Telegram-style: kept until an offset confirms them
+        self._pushed = asyncio.Event()
+        self.fb = {}
+        self._msg_id = 0
+
+    # ---- plumbing ----
+    async def _delay(self, upstream):
+        self.calls[upstream] += 1
+        lat = self.latency.get(upstream, 0.0)
+        if lat:
+            await asyncio.sleep(random.uniform(0.5 * lat, 1.5 * lat))
+        if random.random() < self.errors.get(upstream, 0.0):
+            self.failures[upstream] += 1
+            return random.choice((429, 503))
+        return None
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, _ = line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    h = await reader.readline()
+                    if h in (b"\r\n", b"\n", b""):
+                        break
+                    k, v = h.decode("latin-1").split(":", 1)
+                    headers[k.strip().lower()] = v.strip()
+                if headers.get("transfer-encoding", "").lower() == "chunked":
+                    body = b""
+                    while True:
+                        n = int((await reader.readline()).strip(), 16)
+                        if n == 0:
+                            await reader.readline()
+                            break
+                        body += await reader.readexactly(n)
+                        await reader.readline()
+                else:
+                    body = await reader.readexactly(int(headers.get("content-length", 0)))
+                await self.route(method, target, headers, body, writer)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    @staticmethod
+    def _reply(writer, status, payload, ctype="application/json"):
+        body = payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+        writer.write(
+            f"HTTP/1.1 {status} X\r\nContent-Type: {ctype}\r\nContent-Length: {len(body)}\r\n"
+            f"Connection: keep-alive\r\n\r\n".encode() + body
+        )
+
+    async def route(self, method, target, headers, body, writer):
+        url = urlsplit(target)
+        path, query = url.path, parse_qs(url.query)
+        if path == "/__stats":
+            return self._reply(writer, 200, {"calls": self.calls, "failures": self.failures, "flooded": self.flooded,
+                                                "events": self.events})
+        if path == "/__reset":
+            self.reset()
+            return self._reply(writer, 200, {"ok": True})
+        if path == "/__updates":
+            self.updates.extend(json.loads(body or b"[]"))
+            self._pushed.set()
+            return self._reply(writer, 200, {"ok": True})
+        if path.startswith("/bot"):
+            return await self.telegram(path, headers, body, writer)
+        if path.endswith(":streamGenerateContent"):
+            return await self.gemini_stream(writer)
+        if path.endswith(":generateContent"):
+            return await self.gemini(writer)
+        if path.endswith(":predict"):
+            return await self.vertex(body, writer)
+        if path.startswith("/customsearch/"):
+            return await self.search(query, writer)
+        if path.startswith("/fb/") and path.endswith(".json"):
+            return await self.firebase(method, path[4:-5].strip("/"), body, writer)
+        self._reply(writer, 404, {"error": "not found"})
+
+    # ---- Telegram ----
+    def _flood_wait(self, chat_id, edit=False):
+        """Seconds to retry after when this send breaks a --flood limit, else 0.
+        Edits count against the chat limit only, not the bot-wide one."""
+        now = time.monotonic()
+        keys = (chat_id,) if edit else (chat_id, None)
+        for key, limit in ((chat_id, self.flood.get("chat")), (None, self.flood.get("global"))):
+            if not limit or key not in keys:
+                continue
+            recent = self._recent.setdefault(key, deque())
+            while recent and now - recent[0] >= 1.0:
+                recent.popleft()
+            if len(recent) >= limit:
+                self.flooded += 1
+                return max(1, int(1.0 - (now - recent[0]) + 0.999))
+        for key in keys:
+            self._recent.setdefault(key, deque()).append(now)
+        return 0
+
+    @staticmethod
+    def _form(headers, body):
+        ctype = headers.get("content-type", "")
+        if "multipart/form-data" in ctype:
+            out = {}
+            for name, value in re.findall(rb'name="([^"]+)"\r\n(?:[^\r\n]+\r\n)*\r\n(.{0,4096}?)\r\n--', body, re.S):
+                out[name.decode()] = value.decode(errors="replace")
+            return out
+        if "json" in ctype:
+            return json.loads(body or b"{}")
+        return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+
+    def _message(self, chat_id, text=None, photo=False):
+        self._msg_id += 1
+        msg = {"message_id": self._msg_id, "date": int(time.time()),
+               "chat": {"id": int(chat_id or 0), "type": "private"}}
+        if text is not None:
+            msg["text"] = text
+        if photo:
+            fid = f"file{self._msg_id}"
+            msg["photo"] = [{"file_id": fid, "file_unique_id": fid, "width": 256, "height": 256}]
+        return msg
+
+    async def telegram(self, path, headers, body, writer):
+        api_method = path.rsplit("/", 1)[-1].lower()
+        form = self._form(headers, body)
+        if api_method == "getupdates":
+            timeout = float(form.get("timeout") or 0)
+            offset = int(form.get("offset") or 0)
+            if offset:
+                self.updates = [u for u in self.updates if u["update_id"] >= offset]
+            deadline = time.monotonic() + max(timeout, 0.5)
+            while not self.updates and time.monotonic() < deadline:
+                self._pushed.clear()
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(self._pushed.wait(), deadline - time.monotonic())
+            batch = self.updates[:int(form.get("limit") or 100)]
+            return self._reply(writer, 200, {"ok": True, "result": batch})
+        status = await self._delay("telegram")
+        if status:
+            return self._reply(writer, status, {"ok": False, "error_code": status, "description": "Too Many Requests",
+                                                "parameters": {"retry_after": 1}})
+        chat_id = form.get("chat_id")
+        if chat_id is not None and self.flood:
+            wait = self._flood_wait(int(chat_id), edit=api_method.startswith("edit"))
+            if wait:
+                return self._reply(writer, 429, {"ok": False, "error_code": 429,
+                                                 "description": f"Too Many Requests: retry after {wait}",
+                                                 "parameters": {"retry_after": wait}})
+        if api_method == "getme":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif api_method in ("sendmessage", "editmessagetext"):
+            result = self._message(chat_id, form.get("text", ""))
+        elif api_method in ("sendphoto", "senddocument"):
+            result = self._message(chat_id, photo=True)
+        elif api_method == "sendmediagroup":
+            n = max(1, len(json.loads(form.get("media") or "[]")) if form.get("media", "").startswith("[") else 1)
+            result = [self._message(chat_id, photo=True) for _ in range(n)]
+        else:
+            result = True
+        if chat_id is not None:
+            self.events.append((time.time(), api_method, int(chat_id)))
+        self._reply(writer, 200, {"ok": True, "result": result})
+
+    # ---- Google ----
+    def _answer(self):
+        return " ".join(random.choice(("surf", "wave", "ocean", "board", "tide", "reef")) for _ in range(self.answer_words))
+
+    async def gemini(self, writer):
+        status = await self._delay("gemini")
+        if status:
+            return self._reply(writer, status, {"error": {"code": status}})
+        self._reply(writer, 200, {"candidates": [{"content": {"parts": [{"text": self._answer()}]}}]})
+
+    async def gemini_stream(self, writer):
+        status = await self._delay("gemini")
+        if status:
+            return self._reply(writer, status, {"error": {"code": status}})
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nTransfer-Encoding: chunked\r\n"
+                     b"Connection: keep-alive\r\n\r\n")
+        words = self._answer().split()
+        step = max(1, len(words) // 8)
+        for i in range(0, len(words), step):
+            event = {"candidates": [{"content": {"parts": [{"text": " ".join(words[i:i + step]) + " "}]}}]}
+            data = f"data: {json.dumps(event)}\r\n\r\n".encode()
+            writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            await writer.drain()
+            await asyncio.sleep(self.latency["gemini"] / 8)
+        writer.write(b"0\r\n\r\n")
+
+    async def vertex(self, body, writer):
+        status = await self._delay("vertex")
+        if status:
+            return self._reply(writer, status, {"error": {"code": status}})
+        params = (json.loads(body or b"{}").get("parameters") or {})
+        n = int(params.get("sampleCount", 1))
+        self._reply(writer, 200, {"predictions": [{"bytesBase64Encoded": self.image_b64, "mimeType": "image/png"}] * n})
+
+    async def search(self, query, writer):
+        status = await self._delay("search")
+        if status:
+            return self._reply(writer, status, {"error": {"code": status}})
+        q = (query.get("q") or [""])[0]
+        items = [{"title": f"{q} result {i}", "link": f"https://example.com/{i}", "snippet": f"About {q} #{i}"}
+                 for i in range(int((query.get("num") or ["3"])[0]))]
+        self._reply(writer, 200, {"items": items})
+
+    # ---- Firebase RTDB ----
+    def _fb_node(self, path, create=False):
+        node = self.fb
+        keys = [k for k in path.split("/") if k]
+        for k in keys[:-1]:
+            nxt = node.get(k)
+            if not isinstance(nxt, dict):
+                if not create:
+                    return None, None
+                nxt = node[k] = {}
+            node = nxt
+        return node, (keys[-1] if keys else None)
+
+    def _fb_set(self, path, value):
+        parent, key = self._fb_node(path, create=True)
+        if key is None:
+            self.fb = value if isinstance(value, dict) else {}
+            return
+        if isinstance(value, dict) and set(value) == {".sv"}:
+            value = (parent.get(key) or 0) + value[".sv"]["increment"]
+        if value is None:
+            parent.pop(key, None)
+        else:
+            parent[key] = value
+
+    async def firebase(self, method, path, body, writer):
+        status = await self._delay("firebase")
+        if status:
+            return self._reply(writer, status, {"error": "unavailable"})
+        if method == "GET":
+            parent, key = self._fb_node(path)
+            if not path:
+                value = self.fb
+            else:
+                value = parent.get(key) if parent is not None else None
+            return self._reply(writer, 200, value)
+        data = json.loads(body or b"null")
+        if method == "PATCH":
+            for sub, value in (data or {}).items():
+                self._fb_set(f"{path}/{sub}" if path else sub, value)
+        else:
+            self._fb_set(path, data)
+        self._reply(writer, 200, data)
+
+async def serve(host: str, port: int, fakes: FakeUpstreams):
+    server = await asyncio.start_server(fakes.handle, host, port)
+    async with server:
+        await server.serve_forever()
+
+def main():
+    ap = argparse.ArgumentParser(description="Local fake upstreams for bot_pro benchmarks")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8089)
+    ap.add_argument("--latency", default="", help="per-upstream mean latency, e.g. vertex=3,gemini=0.8")
+    ap.add_argument("--errors", default="", help="per-upstream error rate 0..1, e.g. vertex=0.05")
+    ap.add_argument("--image-size", type=int, default=256, help="side of the generated PNG in pixels")
+    ap.add_argument("--flood", default="", help="Telegram sends/s limits, e.g. chat=1,global=30 (429 beyond)")
+    args = ap.parse_args()
+    fakes = FakeUpstreams(parse_kv(args.latency), parse_kv(args.errors), args.image_size, flood=parse_kv(args.flood))
+    print(f"fake upstreams on http://{args.host}:{args.port}", file=sys.stderr, flush=True)
+    try:
+        asyncio.run(serve(args.host, args.port, fakes))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,353 @@
+# bench/loadtest.py — replay synthetic Telegram traffic through bot_pro against local fakes
+#
+#   python bench/loadtest.py --mode webhook --updates 500 --rate 50 --mix ask=4,search=4,image=1,quota=1
+#   python bench/loadtest.py --mode polling --save-baseline
+#   python bench/loadtest.py --mode sharded --workers 4        # POLL_WORKERS=4 bot_pro.py in a subprocess
+#
+# Starts bench/fakes.py in a subprocess, points bot_pro at it through the
+# *_BASE_URL env vars, feeds updates through the ASGI webhook (webhook mode) or
+# the fake getUpdates endpoint (polling mode), then reports throughput,
+# p50/p95/p99 per command, outbound calls per upstream and peak RSS, and
+# compares them against a stored baseline.
+import os
+import sys
+import json
+import time
+import random
+import signal
+import socket
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+DEFAULT_BASELINE = os.path.join(HERE, "baseline.json")
+
+QUERIES = {
+    "ask": ["what is surfing", "how do tides work", "best surfboard for beginners", "why is the sea salty",
+            "explain rip currents", "who invented the wetsuit", "how tall was the biggest wave"],
+    "search": ["Taj Mahal", "(5*4)/2", "surf forecast", "2+2*3", "python asyncio", "Goa beaches", "12/(3+1)"],
+    "image": ["a beautiful landscape", "a surfer at sunset --size 512", "a red fox --seed 42",
+              "a lighthouse in fog --seed 7 --size 768", "neon city --no people",
+              "koi pond --n 3", "a red fox --seed 42 --n 2"],
+    "quota": [""],
+}
+
+def parse_kv(spec: str, cast=float):
+    out = {}
+    for part in (spec or "").split(","):
+        if "=" in part:
+            k, v = part.split("=", 1)
+            out[k.strip()] = cast(v)
+    return out
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def control(base: str, path: str, data=None):
+    req = urllib.request.Request(base + path, data=None if data is None else json.dumps(data).encode(),
+                                 method="GET" if data is None else "POST")
+    with urllib.request.urlopen(req, timeout=30) as resp:
+        return json.loads(resp.read())
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return round(values[lo] + (values[hi] - values[lo]) * (k - lo), 4)
+
+def make_updates(n: int, mix: dict, users: int, repeat: float, seed: int):
+    """Synthetic command updates; each gets its own chat id so replies can be attributed."""
+    rnd = random.Random(seed)
+    commands = [c for c in mix if c in QUERIES]
+    weights = [mix[c] for c in commands]
+    updates = []
+    for i in range(n):
+        cmd = rnd.choices(commands, weights)[0]
+        arg = rnd.choice(QUERIES[cmd])
+        if arg and rnd.random() > repeat:
+            arg = f"{arg} {i}"           # unique query -> cache miss
+        text = f"/{cmd} {arg}".strip()
+        uid = 1000 + rnd.randrange(users)
+        updates.append({
+            "update_id": i + 1,
+            "message": {
+                "message_id": i + 1, "date": int(time.time()), "text": text,
+                "chat": {"id": 10_000_000 + i, "type": "private"},
+                "from": {"id": uid, "is_bot": False, "first_name": f"u{uid}"},
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(cmd) + 1}],
+            },
+        })
+    return updates
+
+async def _asgi_post(asgi_app, path: str, body: bytes):
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {"type": "http", "method": "POST", "path": path, "headers": [(b"content-type", b"application/json")]}
+    await asgi_app(scope, receive, send)
+    return sent[0]["status"] if sent else None
+
+async def run_webhook(bot, updates, rate):
+    """Drive the ASGI webhook in-process; returns send times and ack latencies."""
+    await bot.dispatcher.start(bot.application)
+    sent_at, acks, statuses = {}, [], {}
+    start = time.perf_counter()
+    for i, upd in enumerate(updates):
+        if rate:
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        t0 = time.perf_counter()
+        sent_at[upd["message"]["chat"]["id"]] = time.time()
+        status = await _asgi_post(bot.asgi_app, f"/{bot.BOT_SECRET}", json.dumps(upd).encode())
+        acks.append(time.perf_counter() - t0)
+        statuses[status] = statuses.get(status, 0) + 1
+    await bot.dispatcher.stop()
+    return sent_at, {"ack_p50": percentile(acks, 50), "ack_p99": percentile(acks, 99),
+                     "ack_status": {str(k): v for k, v in statuses.items()}}
+
+async def run_polling(bot, updates, rate, fake_base, settle):
+    """Start PTB polling against the fake getUpdates and push updates at `rate`."""
+    app = bot.application
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.updater.start_polling(poll_interval=0.0, timeout=1)
+    await app.start()
+    sent_at = {}
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    for i, upd in enumerate(updates):
+        if rate:
+            delay = start + i / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        sent_at[upd["message"]["chat"]["id"]] = time.time()
+        await loop.run_in_executor(None, control, fake_base, "/__updates", [upd])
+    # wait until no new Telegram traffic for `settle` seconds
+    last = -1
+    while True:
+        await asyncio.sleep(settle)
+        n = len((await loop.run_in_executor(None, control, fake_base, "/__stats"))["events"])
+        if n == last:
+            break
+        last = n
+    await app.updater.stop()
+    await app.stop()
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+    await app.shutdown()
+    return sent_at, {}
+
+def run_sharded(updates, rate, fake_base, settle, workers):
+    """Run `python bot_pro.py` with POLL_WORKERS=workers against the fake getUpdates,
+    push updates at `rate`, then SIGTERM it (graceful drain) once traffic settles."""
+    env = dict(os.environ, POLL_WORKERS=str(workers),
+               SHARD_STATE_DB=os.path.join(tempfile.mkdtemp(prefix="surfer_bench_"), "shards.db"))
+    proc = subprocess.Popen([sys.executable, os.path.join(ROOT, "bot_pro.py")], cwd=ROOT, env=env)
+    try:
+        # ready once every worker has initialized (getMe) and the fetcher has called deleteWebhook
+        deadline = time.time() + 60
+        while control(fake_base, "/__stats")["calls"]["telegram"] < workers + 1:
+            if proc.poll() is not None or time.time() > deadline:
+                raise SystemExit("sharded bot did not start")
+            time.sleep(0.1)
+        sent_at = {}
+        start = time.perf_counter()
+        for i, upd in enumerate(updates):
+            if rate:
+                delay = start + i / rate - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            sent_at[upd["message"]["chat"]["id"]] = time.time()
+            control(fake_base, "/__updates", [upd])
+        last = -1
+        while True:
+            time.sleep(settle)
+            n = len(control(fake_base, "/__stats")["events"])
+            if n == last:
+                break
+            last = n
+        t0 = time.perf_counter()
+        proc.send_signal(signal.SIGTERM)
+        proc.wait(timeout=120)
+        return sent_at, {"workers": workers, "drain_s": round(time.perf_counter() - t0, 3), "exit_code": proc.returncode,
+                         "bot_peak_rss_mb": round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0, 1)}
+    finally:
+        if proc.poll() is None:
+            proc.kill()
+
+def summarize(updates, sent_at, stats, extra, wall):
+    by_chat = {}
+    for t, method, chat in stats["events"]:
+        first, last, n = by_chat.get(chat, (t, t, 0))
+        by_chat[chat] = (min(first, t), max(last, t), n + 1)
+    per_cmd, done_times, unanswered = {}, [], 0
+    for upd in updates:
+        chat = upd["message"]["chat"]["id"]
+        cmd = upd["message"]["text"].split()[0][1:]
+        entry = per_cmd.setdefault(cmd, {"first": [], "done": [], "sends": 0})
+        if chat not in by_chat:
+            unanswered += 1
+            continue
+        first, last, n = by_chat[chat]
+        entry["first"].append(first - sent_at[chat])
+        entry["done"].append(last - sent_at[chat])
+        entry["sends"] += n
+        done_times.append(last)
+    span = (max(done_times) - min(sent_at.values())) if done_times else wall
+    report = {
+        "updates": len(updates),
+        "unanswered": unanswered,
+        "throughput_ups": round(len(updates) / span, 3) if span > 0 else None,
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, 1),
+        "outbound_calls": stats["calls"],
+        "upstream_failures": stats["failures"],
+        "telegram_flood_429": stats.get("flooded", 0),
+        "commands": {},
+        **extra,
+    }
+    for cmd, e in sorted(per_cmd.items()):
+        report["commands"][cmd] = {
+            "n": len(e["done"]),
+            "first_p50": percentile(e["first"], 50),
+            "p50": percentile(e["done"], 50),
+            "p95": percentile(e["done"], 95),
+            "p99": percentile(e["done"], 99),
+            "telegram_calls_per_update": round(e["sends"] / len(e["done"]), 2) if e["done"] else None,
+        }
+    return report
+
+def compare(report, baseline, tolerance):
+    """Lines describing metrics that moved more than `tolerance` (fraction) vs baseline."""
+    lines = []
+
+    def check(name, cur, base, higher_is_better=False):
+        if cur is None or not base:
+            return
+        change = (cur - base) / base
+        worse = change < -tolerance if higher_is_better else change > tolerance
+        better = change > tolerance if higher_is_better else change < -tolerance
+        if worse or better:
+            lines.append(f"{'REGRESSION' if worse else 'improved  '} {name}: {base} -> {cur} ({change:+.0%})")
+
+    check("throughput_ups", report["throughput_ups"], baseline.get("throughput_ups"), higher_is_better=True)
+    check("peak_rss_mb", report["peak_rss_mb"], baseline.get("peak_rss_mb"))
+    for up, n in report["outbound_calls"].items():
+        check(f"outbound_calls.{up}", n, baseline.get("outbound_calls", {}).get(up))
+    for cmd, cur in report["commands"].items():
+        base = baseline.get("commands", {}).get(cmd, {})
+        for key in ("p50", "p95", "p99"):
+            check(f"{cmd}.{key}", cur[key], base.get(key))
+    return lines
+
+def configure_env(args, fake_base):
+    env = {
+        "TELEGRAM_TOKEN": "123456:bench", "BOT_SECRET": "bench",
+        "GEMINI_API_KEY": "bench", "GOOGLE_API_KEY": "bench", "SEARCH_ENGINE_ID": "bench",
+        "VERTEX_PROJECT_ID": "bench", "VERTEX_LOCATION": "local",
+        "TELEGRAM_API_BASE": fake_base,
+        "GEMINI_BASE_URL": f"{fake_base}/v1beta/models",
+        "VERTEX_BASE_URL": fake_base,
+        "SEARCH_API_URL": f"{fake_base}/customsearch/v1",
+        "FIREBASE_DB_URL": f"{fake_base}/fb",
+        "QUOTA_BACKEND": args.backend,
+        "QUOTA_DB_PATH": os.path.join(tempfile.mkdtemp(prefix="surfer_bench_"), "quota.db"),
+        # keep the bot's own limits out of the way unless the caller set them
+        "DEFAULT_DAILY_LIMIT": "1000000", "MONTHLY_GLOBAL_CAP": "1000000000", "COOLDOWN_SECONDS": "0",
+        "ASK_RATE_PER_MIN": "0", "SEARCH_RATE_PER_MIN": "0", "VERTEX_RPM": "0", "GEMINI_RPM": "0",
+    }
+    for k, v in env.items():
+        os.environ.setdefault(k, v)
+
+def main():
+    ap = argparse.ArgumentParser(description="Load-test bot_pro against local fake upstreams")
+    ap.add_argument("--mode", choices=("webhook", "polling", "sharded"), default="webhook")
+    ap.add_argument("--workers", type=int, default=2, help="sharded mode: worker processes")
+    ap.add_argument("--updates", type=int, default=300)
+    ap.add_argument("--rate", type=float, default=50.0, help="updates per second (0 = one burst)")
+    ap.add_argument("--mix", default="ask=4,search=4,image=1,quota=1")
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--repeat", type=float, default=0.3, help="share of queries repeated verbatim (cache hits)")
+    ap.add_argument("--latency", default="", help="fake upstream latency, e.g. vertex=3,gemini=0.8")
+    ap.add_argument("--errors", default="", help="fake upstream error rate, e.g. vertex=0.05")
+    ap.add_argument("--flood", default="", help="fake Telegram flood limits (sends/s), e.g. chat=1,global=30")
+    ap.add_argument("--image-size", type=int, default=256)
+    ap.add_argument("--backend", choices=("sqlite", "firebase"), default="sqlite", help="quota store under test")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--settle", type=float, default=2.0, help="polling mode: quiet seconds that end the run")
+    ap.add_argument("--baseline", default=DEFAULT_BASELINE)
+    ap.add_argument("--save-baseline", action="store_true")
+    ap.add_argument("--tolerance", type=float, default=0.2)
+    ap.add_argument("--out", help="also write the JSON report here")
+    args = ap.parse_args()
+
+    port = free_port()
+    fake_base = f"http://127.0.0.1:{port}"
+    fake = subprocess.Popen([sys.executable, os.path.join(HERE, "fakes.py"), "--port", str(port),
+                             "--latency", args.latency, "--errors", args.errors,
+                             "--image-size", str(args.image_size), "--flood", args.flood])
+    try:
+        for _ in range(100):
+            try:
+                control(fake_base, "/__stats")
+                break
+            except OSError:
+                time.sleep(0.1)
+        configure_env(args, fake_base)
+        updates = make_updates(args.updates, parse_kv(args.mix), args.users, args.repeat, args.seed)
+        control(fake_base, "/__reset", {})
+        t0 = time.perf_counter()
+        if args.mode == "sharded":
+            sent_at, extra = run_sharded(updates, args.rate, fake_base, args.settle, args.workers)
+        else:
+            sys.path.insert(0, ROOT)
+            import bot_pro
+        if args.mode == "webhook":
+            sent_at, extra = asyncio.run(run_webhook(bot_pro, updates, args.rate))
+        elif args.mode == "polling":
+            sent_at, extra = asyncio.run(run_polling(bot_pro, updates, args.rate, fake_base, args.settle))
+        wall = time.perf_counter() - t0
+        report = summarize(updates, sent_at, control(fake_base, "/__stats"), extra, wall)
+        report["config"] = {k: getattr(args, k) for k in ("mode", "updates", "rate", "mix", "users", "repeat",
+                                                          "latency", "errors", "backend")}
+        if args.flood:
+            report["config"]["flood"] = args.flood
+    finally:
+        fake.terminate()
+        fake.wait()
+
+    print(json.dumps(report, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline saved to {args.baseline}", file=sys.stderr)
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            print("note: baseline was recorded with a different config", file=sys.stderr)
+        lines = compare(report, baseline, args.tolerance)
+        print("\n".join(lines) if lines else "no change beyond tolerance vs baseline", file=sys.stderr)
+        if any(line.startswith("REGRESSION") for line in lines):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,41 @@
 # bot_pro.py — Final deploy-ready (friendly messages, quota, admin, help)
+from __future__ import annotations
+
 import os
-import io
+import ast
+import html
+import math
 import re
 import json
 import time
 import base64
+import hashlib
+import heapq
+import itertools
+import random
+import queue
+import shutil
+import signal
+import sqlite3
+import tempfile
 import datetime
 import logging
 import asyncio
-import requests
-import numexpr
+import contextlib
+import contextvars
+import concurrent.futures
+import functools
+import threading
+import httpx
+from array import array
+from collections import OrderedDict, deque
 from dotenv import load_dotenv
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, Counter, Gauge, Histogram, generate_latest
+from prometheus_client.core import GaugeMetricFamily
 
-from flask import Flask, request as flask_request
-from telegram import Update, InputFile, BotCommand
-from telegram.ext import ApplicationBuilder, CommandHandler, ContextTypes
-from telegram.constants import ParseMode
-
-# Firebase admin SDK
-import firebase_admin
-from firebase_admin import credentials, db
+# Heavy imports (numexpr/NumPy, flask, telegram.ext, firebase_admin) are deferred
+# to first use so a serverless cold start only pays for what the request needs.
+# See "Lazy startup" below and bench/coldstart.py.
 
 # ------------- Load environment -------------
 load_dotenv()
@@ -37,19 +53,139 @@ GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")                 # used for Generati
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 SEARCH_ENGINE_ID = os.getenv("SEARCH_ENGINE_ID")
 
+# Upstream base URLs (override to point the bot at local stand-ins, e.g. bench/fakes.py)
+TELEGRAM_API_BASE = os.getenv("TELEGRAM_API_BASE", "https://api.telegram.org")
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "https://generativelanguage.googleapis.com/v1beta/models")
+VERTEX_BASE_URL = os.getenv("VERTEX_BASE_URL", "https://{location}-aiplatform.googleapis.com")
+SEARCH_API_URL = os.getenv("SEARCH_API_URL", "https://www.googleapis.com/customsearch/v1")
+
 # Admins and caps
 ADMIN_USER_IDS = set([s.strip() for s in (os.getenv("ADMIN_USER_IDS") or "").split(",") if s.strip()])
 COOLDOWN_SECONDS = int(os.getenv("COOLDOWN_SECONDS", "5"))
 DEFAULT_DAILY_LIMIT = int(os.getenv("DEFAULT_DAILY_LIMIT", "10"))
 DEFAULT_MONTHLY_CAP = int(os.getenv("MONTHLY_GLOBAL_CAP", "100"))
 
+# Quota storage: "firebase", "sqlite" or "auto" (Firebase when ready, else local SQLite)
+QUOTA_BACKEND = os.getenv("QUOTA_BACKEND", "auto").lower()
+QUOTA_DB_PATH = os.getenv("QUOTA_DB_PATH", os.path.join(tempfile.gettempdir(), "surfer_quota.db"))
+SQLITE_BUSY_TIMEOUT = float(os.getenv("SQLITE_BUSY_TIMEOUT", "0.25"))  # seconds a write waits on another process's lock
+
+# Quota cache (read LRU/TTL + write-back buffer)
+QUOTA_CACHE_SIZE = int(os.getenv("QUOTA_CACHE_SIZE", "10000"))
+QUOTA_CACHE_TTL = float(os.getenv("QUOTA_CACHE_TTL", "30"))
+QUOTA_FLUSH_INTERVAL = float(os.getenv("QUOTA_FLUSH_INTERVAL", "2"))
+
+# Rate limits (local token buckets); per-user unless noted
+ASK_RATE_PER_MIN = float(os.getenv("ASK_RATE_PER_MIN", "10"))
+SEARCH_RATE_PER_MIN = float(os.getenv("SEARCH_RATE_PER_MIN", "20"))
+VERTEX_RPM = float(os.getenv("VERTEX_RPM", "30"))                  # global
+GEMINI_RPM = float(os.getenv("GEMINI_RPM", "60"))                  # global
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "500000"))
+
+# Webhook ingestion
+WEBHOOK_CONCURRENCY = int(os.getenv("WEBHOOK_CONCURRENCY", "64"))    # updates processed at once
+WEBHOOK_MAX_PENDING = int(os.getenv("WEBHOOK_MAX_PENDING", "1000"))   # queued + running before 503
+WEBHOOK_DEDUP_SIZE = int(os.getenv("WEBHOOK_DEDUP_SIZE", "10000"))
+
+# /ask and /search response cache
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(8 * 1024 * 1024)))
+RESPONSE_CACHE_DB = os.getenv("RESPONSE_CACHE_DB")                 # optional SQLite file for the disk tier
+RESPONSE_CACHE_DB_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_DB_MAX_BYTES", str(64 * 1024 * 1024)))
+ASK_CACHE_TTL = float(os.getenv("ASK_CACHE_TTL", "3600"))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", "900"))
+
+# /search safe-math engine
+MATH_MAX_LENGTH = int(os.getenv("MATH_MAX_LENGTH", "200"))          # longer queries go to Google
+MATH_CACHE_SIZE = int(os.getenv("MATH_CACHE_SIZE", "1024"))          # compiled expressions kept
+MATH_MAX_EXPONENT = int(os.getenv("MATH_MAX_EXPONENT", "10000"))
+MATH_MAX_INT_BITS = int(os.getenv("MATH_MAX_INT_BITS", "4096"))      # ~1200 digits
+MATH_MAX_BATCH = int(os.getenv("MATH_MAX_BATCH", "100000"))          # values in `expr for x in a..b`
+MATH_TIMEOUT = float(os.getenv("MATH_TIMEOUT", "1.0"))              # seconds per batch evaluation
+
+# Usage aggregates
+STATS_TOP_USERS = int(os.getenv("STATS_TOP_USERS", "10"))
+STATS_KEEP_DAYS = int(os.getenv("STATS_KEEP_DAYS", "30"))         # /compactstats archives older per-day user records
+
+# /image job scheduler
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))               # concurrent Vertex generations
+IMAGE_QUEUE_MAX = int(os.getenv("IMAGE_QUEUE_MAX", "50"))
+IMAGE_JOB_MAX_WAIT = float(os.getenv("IMAGE_JOB_MAX_WAIT", "180"))  # queued longer than this -> dropped
+IMAGE_MAX_SAMPLES = int(os.getenv("IMAGE_MAX_SAMPLES", "4"))       # /image --n upper bound (one predict call)
+
+# Image delivery pipeline
+IMAGE_DELIVERY = os.getenv("IMAGE_DELIVERY", "photo").lower()      # photo | document (full-quality original file)
+IMAGE_UPLOAD_FORMAT = os.getenv("IMAGE_UPLOAD_FORMAT", "png").lower()   # png (as generated) | jpeg | webp (needs Pillow)
+IMAGE_UPLOAD_QUALITY = int(os.getenv("IMAGE_UPLOAD_QUALITY", "85"))
+IMAGE_SPOOL_MAX_MEMORY = int(os.getenv("IMAGE_SPOOL_MAX_MEMORY", str(1024 * 1024)))   # per image, then temp file
+IMAGE_INFLIGHT_MAX_BYTES = int(os.getenv("IMAGE_INFLIGHT_MAX_BYTES", str(64 * 1024 * 1024)))  # all jobs together
+
+# Streaming /ask answers
+ASK_STREAM = os.getenv("ASK_STREAM", "1") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))  # min seconds between edits of one message
+TELEGRAM_MAX_MESSAGE = 4096
+
+# Outbound Telegram queue (Bot API flood limits: ~1 msg/s per chat, 20/min per group, ~30/s overall)
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))        # sends/s per private chat (0 = off)
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_GROUP_PER_MIN = float(os.getenv("TELEGRAM_GROUP_PER_MIN", "20"))
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))    # sends/s for the whole bot
+OUTBOX_COALESCE_CHARS = int(os.getenv("OUTBOX_COALESCE_CHARS", "1024"))  # queued replies up to this size get merged
+OUTBOX_MAX_RETRIES = int(os.getenv("OUTBOX_MAX_RETRIES", "3"))           # RetryAfter retries per send
+
+# Seeded /image cache (Telegram file_ids + optional on-disk bytes)
+IMAGE_CACHE_SIZE = int(os.getenv("IMAGE_CACHE_SIZE", "5000"))
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR")                     # optional, e.g. /tmp/surfer_images
+IMAGE_CACHE_DIR_MAX_BYTES = int(os.getenv("IMAGE_CACHE_DIR_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# Upstream resilience: per-call deadline (seconds, retries included) and max attempts
+GEMINI_DEADLINE = float(os.getenv("GEMINI_DEADLINE", "45"))
+GEMINI_MAX_ATTEMPTS = int(os.getenv("GEMINI_MAX_ATTEMPTS", "3"))
+VERTEX_DEADLINE = float(os.getenv("VERTEX_DEADLINE", "90"))
+VERTEX_MAX_ATTEMPTS = int(os.getenv("VERTEX_MAX_ATTEMPTS", "2"))
+VERTEX_FALLBACK_LOCATIONS = [s.strip() for s in (os.getenv("VERTEX_FALLBACK_LOCATIONS") or "").split(",") if s.strip()]
+SEARCH_DEADLINE = float(os.getenv("SEARCH_DEADLINE", "10"))
+SEARCH_MAX_ATTEMPTS = int(os.getenv("SEARCH_MAX_ATTEMPTS", "3"))
+HEDGE_UPSTREAMS = set(s.strip() for s in os.getenv("HEDGE_UPSTREAMS", "search").split(",") if s.strip())
+RETRY_BUDGET_RATIO = float(os.getenv("RETRY_BUDGET_RATIO", "0.1"))   # retries+hedges per first attempt
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))           # consecutive failures that open a breaker
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", "30"))        # seconds open before a probe is let through
+
+# Observability
+LOG_TRACE_IDS = os.getenv("LOG_TRACE_IDS", "0") == "1"              # tag log lines with the update being handled
+TELEGRAM_HTTP_POOL = int(os.getenv("TELEGRAM_HTTP_POOL", "256"))
+
+# Startup
+LAZY_STARTUP = os.getenv("LAZY_STARTUP", "1") == "1"                 # 0 = import/build everything at module load
+
+# Sharded polling (`python bot_pro.py` with POLL_WORKERS > 1): one getUpdates fetcher + N worker processes
+POLL_WORKERS = int(os.getenv("POLL_WORKERS", "1"))
+POLL_TIMEOUT = int(os.getenv("POLL_TIMEOUT", "30"))                  # getUpdates long-poll seconds
+SHARD_MAX_INFLIGHT = int(os.getenv("SHARD_MAX_INFLIGHT", "1000"))    # routed, unfinished updates before fetching pauses
+SHARD_DRAIN_TIMEOUT = float(os.getenv("SHARD_DRAIN_TIMEOUT", "30"))  # shutdown: time the workers get to finish
+SHARD_STATE_DB = os.getenv("SHARD_STATE_DB", os.path.join(tempfile.gettempdir(), "surfer_shards.db"))  # shared rate limits
+
 # Logging
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+trace_id_var = contextvars.ContextVar("trace_id", default="-")
+
+class _TraceIdFilter(logging.Filter):
+    def filter(self, record):
+        record.trace_id = trace_id_var.get()
+        return True
+
+if LOG_TRACE_IDS:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - [%(trace_id)s] %(message)s")
+else:
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+for _handler in logging.getLogger().handlers:
+    _handler.addFilter(_TraceIdFilter())
 logger = logging.getLogger(__name__)
 
 # ------------- Initialize Firebase (if credentials provided) -------------
+# firebase_admin is slow to import; if this block comes back, import it here lazily.
 # FIREBASE_READY = False
 # try:
+#     import firebase_admin
+#     from firebase_admin import credentials
 #     if not firebase_admin._apps:
 #         if os.path.exists("firebase.json") and FIREBASE_DB_URL:
 #             cred = credentials.Certificate("firebase.json")
@@ -71,35 +207,786 @@ logger = logging.getLogger(__name__)
 # THIS IS A TEMPORARY VALUE FOR DEBUGGING
 FIREBASE_READY = False
 
-# ------------- Helpers: run blocking requests in executor -------------
+# ------------- Metrics (Prometheus) & trace ids -------------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216)
+
+HANDLER_SECONDS = Histogram("bot_handler_seconds", "Command handler latency", ["command"], buckets=LATENCY_BUCKETS)
+HANDLER_IN_FLIGHT = Gauge("bot_handler_in_flight", "Command handlers currently running", ["command"])
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Command handlers that raised", ["command"])
+UPSTREAM_SECONDS = Histogram("bot_upstream_seconds", "Outbound call latency", ["upstream"], buckets=LATENCY_BUCKETS)
+UPSTREAM_IN_FLIGHT = Gauge("bot_upstream_in_flight", "Outbound calls currently open", ["upstream"])
+UPSTREAM_RESPONSES = Counter("bot_upstream_responses_total", "Outbound calls by status code (or exception name)",
+                             ["upstream", "status"])
+UPSTREAM_REQUEST_BYTES = Histogram("bot_upstream_request_bytes", "Outbound request body size", ["upstream"],
+                                   buckets=SIZE_BUCKETS)
+UPSTREAM_RETRIES = Counter("bot_upstream_retries_total",
+                           "Extra attempts and refusals by the resilience layer "
+                           "(kind: retry, hedge, budget_exhausted, circuit_open)", ["upstream", "kind"])
+UPSTREAM_RESPONSE_BYTES = Histogram("bot_upstream_response_bytes", "Outbound response body size", ["upstream"],
+                                    buckets=SIZE_BUCKETS)
+
+class _ComponentStatsCollector:
+    """Exports the in-process stats() dicts (caches, scheduler, ...) as gauges."""
+
+    def collect(self):
+        family = GaugeMetricFamily("bot_component_stat", "Internal component counters", labels=["component", "stat"])
+        for component in ("quota_cache", "response_cache", "image_cache", "image_scheduler",
+                          "image_bytes_budget", "rate_limiter", "dispatcher", "resilience",
+                          "math_engine", "outbox"):
+            obj = globals().get(component)
+            if obj is None:
+                continue
+            for stat, value in obj.stats().items():
+                if isinstance(value, (int, float)):
+                    family.add_metric([component, stat], value)
+        yield family
+
+REGISTRY.register(_ComponentStatsCollector())
+
+@contextlib.contextmanager
+def track_upstream(upstream: str, request_bytes: int = 0):
+    """Time one outbound call; the body yields a dict the caller fills with status/response_bytes."""
+    UPSTREAM_IN_FLIGHT.labels(upstream).inc()
+    if request_bytes:
+        UPSTREAM_REQUEST_BYTES.labels(upstream).observe(request_bytes)
+    result = {"status": None, "response_bytes": 0}
+    t0 = time.perf_counter()
+    try:
+        yield result
+    except BaseException as e:
+        result["status"] = result["status"] or type(e).__name__
+        raise
+    finally:
+        elapsed = time.perf_counter() - t0
+        UPSTREAM_IN_FLIGHT.labels(upstream).dec()
+        UPSTREAM_SECONDS.labels(upstream).observe(elapsed)
+        UPSTREAM_RESPONSES.labels(upstream, str(result["status"])).inc()
+        if result["response_bytes"]:
+            UPSTREAM_RESPONSE_BYTES.labels(upstream).observe(result["response_bytes"])
+        if LOG_TRACE_IDS:
+            logger.info("upstream %s -> %s in %.3fs", upstream, result["status"], elapsed)
+
+def instrumented(command: str, callback):
+    """Wrap a handler callback with latency/in-flight/error metrics and a per-update trace id."""
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        token = trace_id_var.set(f"u{update.update_id}")
+        HANDLER_IN_FLIGHT.labels(command).inc()
+        t0 = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.labels(command).inc()
+            raise
+        finally:
+            elapsed = time.perf_counter() - t0
+            HANDLER_SECONDS.labels(command).observe(elapsed)
+            HANDLER_IN_FLIGHT.labels(command).dec()
+            if LOG_TRACE_IDS:
+                logger.info("/%s handled in %.3fs", command, elapsed)
+            trace_id_var.reset(token)
+    return wrapper
+
+@functools.lru_cache(maxsize=None)
+def _instrumented_request_class():
+    """PTB request backend that records Bot API calls as the "telegram" upstream.
+    Built on first use so telegram.request is only imported when the bot starts."""
+    from telegram.request import HTTPXRequest
+
+    class InstrumentedRequest(HTTPXRequest):
+        async def do_request(self, url, method, request_data=None, *args, **kwargs):
+            size = 0
+            if request_data is not None:
+                with contextlib.suppress(Exception):
+                    if request_data.multipart_data:
+                        size = sum(len(part[1]) for part in request_data.multipart_data.values()
+                                   if isinstance(part, tuple) and isinstance(part[1], bytes))
+                    else:
+                        size = len(request_data.json_payload)
+            with track_upstream("telegram", size) as result:
+                status, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+                result["status"] = status
+                result["response_bytes"] = len(payload or b"")
+                return status, payload
+
+    return InstrumentedRequest
+
+def metrics_payload():
+    return generate_latest(REGISTRY), CONTENT_TYPE_LATEST
+
+# ------------- Shared async HTTP client (pooled keep-alive per upstream) -------------
+# service -> (timeout seconds, max pooled connections); override per service via env
+HTTP_SERVICES = {
+    "gemini": (float(os.getenv("GEMINI_HTTP_TIMEOUT", "60")), int(os.getenv("GEMINI_HTTP_POOL", "20"))),
+    "vertex": (float(os.getenv("VERTEX_HTTP_TIMEOUT", "120")), int(os.getenv("VERTEX_HTTP_POOL", "10"))),
+    "search": (float(os.getenv("SEARCH_HTTP_TIMEOUT", "15")), int(os.getenv("SEARCH_HTTP_POOL", "10"))),
+    "firebase": (float(os.getenv("FIREBASE_HTTP_TIMEOUT", "10")), int(os.getenv("FIREBASE_HTTP_POOL", "20"))),
+    "default": (30.0, 10),
+}
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+
+_http_clients = {}
+
+def _service_for(url: str):
+    host = httpx.URL(url).host
+    if host.endswith("aiplatform.googleapis.com"):
+        return "vertex"
+    if host == "generativelanguage.googleapis.com":
+        return "gemini"
+    if host == "www.googleapis.com":
+        return "search"
+    if FIREBASE_DB_URL and host == httpx.URL(FIREBASE_DB_URL).host:
+        return "firebase"
+    return "default"
+
+@functools.lru_cache(maxsize=None)
+def _ssl_context():
+    """One CA-bundle load shared by every client (each load costs ~30ms of cold start)."""
+    return httpx.create_ssl_context()
+
+def _http_client(service: str):
+    client = _http_clients.get(service)
+    if client is None or client.is_closed:
+        timeout, pool = HTTP_SERVICES.get(service, HTTP_SERVICES["default"])
+        client = httpx.AsyncClient(
+            verify=_ssl_context(),
+            timeout=httpx.Timeout(timeout, connect=min(timeout, 10.0)),
+            limits=httpx.Limits(
+                max_connections=pool,
+                max_keepalive_connections=pool,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+        )
+        _http_clients[service] = client
+    return client
+
+async def _async_request(method: str, url: str, service: str | None = None, **kwargs):
+    service = service or _service_for(url)
+    client = _http_client(service)
+    request = client.build_request(method, url, **kwargs)
+    with track_upstream(service, len(request.content)) as result:
+        resp = await client.send(request)
+        result["status"] = resp.status_code
+        result["response_bytes"] = len(resp.content)
+        return resp
+
 async def _async_post(url: str, **kwargs):
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, lambda: requests.post(url, **kwargs))
+    return await _async_request("POST", url, **kwargs)
 
 async def _async_get(url: str, **kwargs):
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, lambda: requests.get(url, **kwargs))
+    return await _async_request("GET", url, **kwargs)
 
 async def _async_put(url: str, **kwargs):
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, lambda: requests.put(url, **kwargs))
+    return await _async_request("PUT", url, **kwargs)
 
-# ------------- Safe math (numexpr) -------------
-def safe_math(expr: str):
-    if not isinstance(expr, str):
-        return None
-    if not re.match(r'^[0-9+\-*/().\s]+$', expr):
-        return None
-    try:
-        val = numexpr.evaluate(expr)
+@contextlib.asynccontextmanager
+async def _async_stream(method: str, url: str, service: str | None = None, **kwargs):
+    """Streaming request on the pooled client; use as `async with ... as resp`.
+    Metrics cover the whole stream, not just the headers."""
+    service = service or _service_for(url)
+    with track_upstream(service) as result:
+        async with _http_client(service).stream(method, url, **kwargs) as resp:
+            result["status"] = resp.status_code
+            yield resp
+            result["response_bytes"] = resp.num_bytes_downloaded
+
+async def close_http_clients():
+    clients = list(_http_clients.values())
+    _http_clients.clear()
+    for client in clients:
         try:
-            return val.item()
-        except Exception:
-            return float(val)
-    except Exception:
+            await client.aclose()
+        except Exception as e:
+            logger.warning("Closing HTTP client failed: %s", e)
+
+# ------------- Upstream resilience: deadlines, retry budget, hedging, breakers -------------
+RETRYABLE_STATUS = frozenset({429, 500, 502, 503, 504})
+RETRY_BACKOFF_BASE = 0.5
+RETRY_BACKOFF_CAP = 8.0
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY = 0.05
+
+class UpstreamUnavailable(Exception):
+    """The call was not made (breaker open) or ran out of deadline/attempts without a response."""
+
+    def __init__(self, upstream: str, reason: str):
+        super().__init__(f"{upstream}: {reason}")
+        self.upstream = upstream
+        self.reason = reason
+
+class _DeadlineStream(httpx.AsyncByteStream):
+    """Response body whose every read is bounded by what is left of the call's
+    deadline; running out raises httpx.ReadTimeout like a stalled read would."""
+
+    def __init__(self, stream: httpx.AsyncByteStream, deadline: float):
+        self.stream = stream
+        self.deadline = deadline
+
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        chunks = self.stream.__aiter__()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(chunks.__anext__(), max(0.0, self.deadline - loop.time()))
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                raise httpx.ReadTimeout("upstream deadline passed while reading the body") from None
+            yield chunk
+
+    async def aclose(self):
+        await self.stream.aclose()
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures and fails fast for `cooldown`
+    seconds; then one probe call is let through per cooldown until one succeeds."""
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = max(1, threshold)
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._probe_at = None
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        return "open" if time.monotonic() - self.opened_at < self.cooldown else "half_open"
+
+    def allow(self):
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        if now - self.opened_at < self.cooldown:
+            return False
+        if self._probe_at is not None and now - self._probe_at < self.cooldown:
+            return False   # a probe is already out
+        self._probe_at = now
+        return True
+
+    def record(self, ok: bool):
+        if ok:
+            self.failures = 0
+            self.opened_at = self._probe_at = None
+            return
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                self.trips += 1
+                logger.warning("Circuit opened after %d failures", self.failures)
+            self.opened_at = time.monotonic()
+
+class RetryBudget:
+    """Shared allowance for retries and hedges: every first attempt earns `ratio`
+    of a token and each extra attempt spends one, so during an incident extra
+    upstream load stays around `ratio` of real traffic instead of multiplying it."""
+
+    def __init__(self, ratio: float, cap: float = 20.0):
+        self.ratio = ratio
+        self.cap = cap
+        self.tokens = cap
+        self.spent = 0
+        self.exhausted = 0
+
+    def deposit(self):
+        self.tokens = min(self.cap, self.tokens + self.ratio)
+
+    def withdraw(self):
+        if self.tokens >= 1.0:
+            self.tokens -= 1.0
+            self.spent += 1
+            return True
+        self.exhausted += 1
+        return False
+
+class Resilience:
+    """Deadline + jittered retries (429/5xx/transport errors) + optional hedging
+    + per-breaker fail-fast around _async_request / _async_stream.
+
+    `policies` maps upstream -> (deadline seconds, max attempts). A hedged
+    second request is sent when the first has not answered within the
+    upstream's recent p95 latency (upstreams in `hedge` only); whichever
+    answers first wins and the other is cancelled. `rates` maps upstream ->
+    rate_limiter table; every hedge and retry takes a token from it, as the
+    first attempt already did at the call site.
+    """
+
+    def __init__(self, policies: dict, hedge: set, budget: RetryBudget, threshold: int, cooldown: float,
+                 rates: dict | None = None):
+        self.policies = policies
+        self.hedge = hedge
+        self.rates = rates or {}
+        self.budget = budget
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.breakers = {}
+        self._latency = {}
+        self.hedges = 0
+        self.hedge_wins = 0
+
+    def breaker(self, key: str):
+        cb = self.breakers.get(key)
+        if cb is None:
+            cb = self.breakers[key] = CircuitBreaker(self.threshold, self.cooldown)
+        return cb
+
+    def available(self, key: str):
+        """False while `key`'s breaker is open (cheap pre-check, takes no probe slot)."""
+        cb = self.breakers.get(key)
+        return cb is None or cb.state != "open"
+
+    def hedge_delay(self, upstream: str):
+        samples = self._latency.get(upstream)
+        if upstream not in self.hedge or not samples or len(samples) < HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return max(HEDGE_MIN_DELAY, ordered[int(len(ordered) * 0.95) - 1])
+
+    def _deadline(self, upstream: str, deadline: float | None):
+        timeout, attempts = self.policies.get(upstream, (60.0, 1))
+        return (deadline or asyncio.get_running_loop().time() + timeout), max(1, attempts)
+
+    def _retry_delay(self, upstream: str, attempt: int, attempts: int, resp, deadline: float):
+        """Backoff before another attempt, or None when out of attempts, time or budget."""
+        if attempt + 1 >= attempts:
+            return None
+        delay = random.uniform(0, min(RETRY_BACKOFF_CAP, RETRY_BACKOFF_BASE * 2 ** attempt))
+        retry_after = resp.headers.get("retry-after", "") if resp is not None else ""
+        if retry_after.isdigit():
+            delay = max(delay, float(retry_after))
+        if asyncio.get_running_loop().time() + delay >= deadline:
+            return None
+        if not self.budget.withdraw():
+            UPSTREAM_RETRIES.labels(upstream, "budget_exhausted").inc()
+            return None
+        UPSTREAM_RETRIES.labels(upstream, "retry").inc()
+        return delay
+
+    async def charge(self, upstream: str, max_wait: float):
+        """Take an RPM token for an extra attempt; False if none arrives within max_wait."""
+        table = self.rates.get(upstream)
+        if table is None or await rate_limiter.acquire(table, max_wait=max(0.0, max_wait)):
+            return True
+        UPSTREAM_RETRIES.labels(upstream, "rate_limited").inc()
+        return False
+
+    async def _timed(self, upstream: str, method: str, url: str, kwargs: dict):
+        t0 = time.monotonic()
+        resp = await _async_request(method, url, service=upstream, **kwargs)
+        if resp.status_code < 400:
+            self._latency.setdefault(upstream, deque(maxlen=200)).append(time.monotonic() - t0)
+        return resp
+
+    async def _attempt(self, upstream: str, method: str, url: str, kwargs: dict):
+        delay = self.hedge_delay(upstream)
+        if delay is None:
+            return await self._timed(upstream, method, url, kwargs)
+        first = asyncio.ensure_future(self._timed(upstream, method, url, kwargs))
+        tasks = [first]
+        try:   # the caller's wait_for may cancel us at any await below
+            await asyncio.wait({first}, timeout=delay)
+            if first.done() or not self.budget.withdraw() or not await self.charge(upstream, 0.0):
+                return await first
+            self.hedges += 1
+            UPSTREAM_RETRIES.labels(upstream, "hedge").inc()
+            second = asyncio.ensure_future(self._timed(upstream, method, url, kwargs))
+            tasks.append(second)
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and task.result().status_code not in RETRYABLE_STATUS:
+                        self.hedge_wins += task is second
+                        return task.result()
+            return task.result()   # both failed: the last one's response or exception
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def request(self, upstream: str, method: str, url: str, *, breaker: str | None = None,
+                      deadline: float | None = None, **kwargs):
+        """httpx.Response of the first non-retryable answer (which may still be a 4xx,
+        or the last 429/5xx when retries run out); UpstreamUnavailable otherwise."""
+        key = breaker or upstream
+        cb = self.breaker(key)
+        deadline, attempts = self._deadline(upstream, deadline)
+        loop = asyncio.get_running_loop()
+        self.budget.deposit()
+        resp = error = None
+        for attempt in range(attempts):
+            if not cb.allow():
+                UPSTREAM_RETRIES.labels(upstream, "circuit_open").inc()
+                raise UpstreamUnavailable(key, "circuit open")
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                resp = await asyncio.wait_for(self._attempt(upstream, method, url, kwargs), remaining)
+                error = None
+            except (httpx.TransportError, asyncio.TimeoutError) as e:
+                resp, error = None, e
+                cb.record(False)
+            else:
+                ok = resp.status_code not in RETRYABLE_STATUS
+                cb.record(ok)
+                if ok:
+                    return resp
+            delay = self._retry_delay(upstream, attempt, attempts, resp, deadline)
+            if delay is None:
+                break
+            logger.info("Retrying %s in %.2fs (%s)", upstream, delay,
+                        resp.status_code if resp is not None else type(error).__name__)
+            await asyncio.sleep(delay)
+            if not await self.charge(upstream, deadline - loop.time()):
+                break
+        if resp is not None:
+            return resp
+        raise UpstreamUnavailable(key, f"no answer ({type(error).__name__ if error else 'deadline'})") from error
+
+    @contextlib.asynccontextmanager
+    async def stream(self, upstream: str, method: str, url: str, *, breaker: str | None = None,
+                     deadline: float | None = None, **kwargs):
+        """_async_stream with breaker, deadline and retries up to the response
+        headers; once the body is flowing a failure is the caller's to handle.
+        The deadline still bounds reading the body (httpx.ReadTimeout past it)."""
+        key = breaker or upstream
+        cb = self.breaker(key)
+        deadline, attempts = self._deadline(upstream, deadline)
+        loop = asyncio.get_running_loop()
+        self.budget.deposit()
+        for attempt in range(attempts):
+            if not cb.allow():
+                UPSTREAM_RETRIES.labels(upstream, "circuit_open").inc()
+                raise UpstreamUnavailable(key, "circuit open")
+            stack = contextlib.AsyncExitStack()
+            resp = error = None
+            try:
+                resp = await asyncio.wait_for(
+                    stack.enter_async_context(_async_stream(method, url, service=upstream, **kwargs)),
+                    max(0.0, deadline - loop.time()))
+            except (httpx.TransportError, asyncio.TimeoutError) as e:
+                error = e
+            if resp is not None and resp.status_code not in RETRYABLE_STATUS:
+                break
+            await stack.aclose()
+            cb.record(False)
+            delay = self._retry_delay(upstream, attempt, attempts, resp, deadline)
+            if delay is not None:
+                await asyncio.sleep(delay)
+            if delay is None or not await self.charge(upstream, deadline - loop.time()):
+                if resp is not None:
+                    resp.raise_for_status()
+                raise UpstreamUnavailable(key, f"no answer ({type(error).__name__ if error else 'deadline'})") from error
+        resp.stream = _DeadlineStream(resp.stream, deadline)
+        async with stack:
+            ok = True
+            try:
+                yield resp
+            except httpx.TransportError:
+                ok = False   # the body broke off; a 4xx raised by the caller is still an answer
+                raise
+            finally:
+                cb.record(ok)
+
+    def stats(self):
+        out = {"retry_tokens": round(self.budget.tokens, 2), "retries_spent": self.budget.spent,
+               "budget_exhausted": self.budget.exhausted, "hedges": self.hedges, "hedge_wins": self.hedge_wins}
+        for key, cb in self.breakers.items():
+            out[f"{key}_open"] = int(cb.state != "closed")
+            out[f"{key}_trips"] = cb.trips
+        return out
+
+resilience = Resilience(
+    {"gemini": (GEMINI_DEADLINE, GEMINI_MAX_ATTEMPTS), "vertex": (VERTEX_DEADLINE, VERTEX_MAX_ATTEMPTS),
+     "search": (SEARCH_DEADLINE, SEARCH_MAX_ATTEMPTS)},
+    HEDGE_UPSTREAMS, RetryBudget(RETRY_BUDGET_RATIO), BREAKER_FAILURES, BREAKER_COOLDOWN,
+    rates={"gemini": "gemini", "vertex": "vertex"},
+)
+
+# ------------- Safe math engine (/search) -------------
+MATH_FUNCS = {
+    "sqrt": math.sqrt, "exp": math.exp, "log": math.log, "log10": math.log10, "log2": math.log2,
+    "sin": math.sin, "cos": math.cos, "tan": math.tan, "asin": math.asin, "acos": math.acos, "atan": math.atan,
+    "sinh": math.sinh, "cosh": math.cosh, "tanh": math.tanh, "floor": math.floor, "ceil": math.ceil,
+    "abs": abs, "round": round, "min": min, "max": max, "hypot": math.hypot,
+    "degrees": math.degrees, "radians": math.radians,
+}
+MATH_CONSTS = {"pi": math.pi, "e": math.e, "tau": math.tau}
+# numexpr spelling of the functions it can vectorize (others fall back to per-value evaluation)
+NUMEXPR_FUNCS = {
+    "sqrt": "sqrt", "exp": "exp", "log": "log", "log10": "log10", "sin": "sin", "cos": "cos", "tan": "tan",
+    "asin": "arcsin", "acos": "arccos", "atan": "arctan", "sinh": "sinh", "cosh": "cosh", "tanh": "tanh",
+    "floor": "floor", "ceil": "ceil", "abs": "abs",
+}
+MATH_MAX_NODES = 200
+MATH_MAX_EXPRESSIONS = 20      # `a; b; c`
+MATH_MAX_SHOWN = 20            # batch values listed before the summary
+MATH_CLOCK_EVERY = 256         # per-value batch loop checks its deadline this often
+MATH_EXACT_LIMIT = 2.0 ** 53   # float64 stops holding every integer here
+_MATH_BINOPS = (ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow)
+_MATH_BATCH = re.compile(r"^(?P<expr>.+?)\s+for\s+(?P<var>[a-z])\s+in\s+(?P<start>-?\d+)\s*\.\.\s*(?P<stop>-?\d+)$")
+
+class MathError(Exception):
+    """A valid expression that cannot be evaluated within the limits."""
+
+class _MathTimeout(MathError):
+    """A batch ran past its deadline."""
+
+class _CompiledMath:
+    __slots__ = ("code", "numexpr", "has_pow")
+
+    def __init__(self, code, numexpr_src, has_pow=False):
+        self.code = code
+        self.numexpr = numexpr_src
+        self.has_pow = has_pow
+
+class _PowGuard(ast.NodeTransformer):
+    """a ** b -> _pow(a, b), so exponents are checked before Python computes them."""
+
+    def visit_BinOp(self, node):
+        self.generic_visit(node)
+        if isinstance(node.op, ast.Pow):
+            return ast.copy_location(ast.Call(ast.Name("_pow", ast.Load()), [node.left, node.right], []), node)
+        return node
+
+def _math_pow(a, b):
+    if abs(b) > MATH_MAX_EXPONENT and abs(a) not in (0, 1):
+        raise MathError("exponent bahut bada hai")
+    if isinstance(a, int) and isinstance(b, int) and b > 0 and b * a.bit_length() > MATH_MAX_INT_BITS:
+        raise MathError("result bahut bada hai")
+    return a ** b
+
+def _format_number(v):
+    if not isinstance(v, float):
+        return str(v)
+    if math.isfinite(v) and v.is_integer() and abs(v) < 1e15:
+        return str(int(v))
+    return f"{v:.12g}"
+
+class MathEngine:
+    """/search calculator: restricted AST -> cached code objects.
+
+    Queries are parsed with `ast`, and anything beyond numbers, + - * / // %
+    ** (or ^), whitelisted math functions and pi/e/tau is rejected (it then
+    goes to Google). Compiled expressions live in an LRU. Scalars are eval'd
+    directly (node count, exponent and integer-size limits keep that cheap
+    enough for the event loop). `expr for x in a..b` batches run in a small
+    thread pool under MATH_TIMEOUT: vectorized with numexpr when every function
+    has a numexpr equivalent, else value by value with the deadline checked
+    inside the loop, so a timed-out batch stops burning its thread. A
+    vectorized result with inf/nan or values beyond float precision is
+    redone value by value, so batches give the same errors and exact
+    integers as scalars.
+    `a; b; c` evaluates each.
+    """
+
+    def __init__(self, cache_size: int, max_batch: int, timeout: float):
+        self.cache_size = cache_size
+        self.max_batch = max_batch
+        self.timeout = timeout
+        self._compiled = OrderedDict()
+        self._executor = None
+        self.hits = 0
+        self.misses = 0
+        self.batches = 0
+        self.vectorized = 0
+        self.timeouts = 0
+        self.errors = 0
+
+    def compile(self, expr: str, var: str | None = None):
+        """_CompiledMath for `expr` (cached), or None when it is not plain math."""
+        key = (expr, var)
+        found = self._compiled.get(key)
+        if found is not None:
+            self._compiled.move_to_end(key)
+            self.hits += 1
+            return found
+        self.misses += 1
+        try:
+            tree = ast.parse(expr.replace("^", "**"), mode="eval")
+        except (SyntaxError, ValueError, RecursionError, MemoryError):
+            return None
+        vectorizable = self._validate(tree, var)
+        if vectorizable is None:
+            return None
+        numexpr_src = self._numexpr_source(tree) if var and vectorizable else None
+        has_pow = any(isinstance(n, ast.Pow) for n in ast.walk(tree))
+        guarded = ast.fix_missing_locations(_PowGuard().visit(tree))
+        compiled = _CompiledMath(compile(guarded, "<math>", "eval"), numexpr_src, has_pow)
+        self._compiled[key] = compiled
+        while len(self._compiled) > self.cache_size:
+            self._compiled.popitem(last=False)
+        return compiled
+
+    @staticmethod
+    def _validate(tree, var):
+        """True/False = allowed (and whether numexpr can run it), None = rejected."""
+        vectorizable = True
+        nodes = list(ast.walk(tree))
+        if len(nodes) > MATH_MAX_NODES:
+            return None
+        for node in nodes:
+            if isinstance(node, (ast.Expression, ast.Load, ast.UAdd, ast.USub) + _MATH_BINOPS):
+                continue
+            if isinstance(node, (ast.UnaryOp, ast.BinOp)):
+                continue   # operators are checked as their own nodes
+            if isinstance(node, ast.Constant):
+                if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+                    return None
+                continue
+            if isinstance(node, ast.Name):
+                if node.id not in MATH_CONSTS and node.id != var and node.id not in MATH_FUNCS:
+                    return None
+                continue
+            if isinstance(node, ast.Call):
+                if not isinstance(node.func, ast.Name) or node.func.id not in MATH_FUNCS or node.keywords:
+                    return None
+                if node.func.id not in NUMEXPR_FUNCS or len(node.args) != 1:
+                    vectorizable = False
+                continue
+            return None
+        # a bare function name (e.g. "sin") is not an expression
+        callees = {id(n.func) for n in nodes if isinstance(n, ast.Call)}
+        if any(isinstance(n, ast.Name) and n.id in MATH_FUNCS and id(n) not in callees for n in nodes):
+            return None
+        return vectorizable
+
+    @staticmethod
+    def _numexpr_source(tree):
+        class Rename(ast.NodeTransformer):
+            def visit_Call(self, node):
+                self.generic_visit(node)
+                node.func = ast.Name(NUMEXPR_FUNCS[node.func.id], ast.Load())
+                return node
+        return ast.unparse(Rename().visit(ast.parse(ast.unparse(tree), mode="eval")))
+
+    @staticmethod
+    def _eval(compiled, names=None):
+        try:
+            value = eval(compiled.code, {"__builtins__": {}, "_pow": _math_pow, **MATH_FUNCS, **MATH_CONSTS}, names or {})
+        except MathError:
+            raise
+        except ZeroDivisionError:
+            raise MathError("zero se divide nahi kar sakte")
+        except (OverflowError, ValueError, TypeError) as e:
+            raise MathError(str(e) or type(e).__name__)
+        if isinstance(value, int) and value.bit_length() > MATH_MAX_INT_BITS:
+            raise MathError("result bahut bada hai")
+        if isinstance(value, complex):
+            raise MathError("complex result")
+        if isinstance(value, float) and not math.isfinite(value):
+            raise MathError("result bahut bada hai")
+        return value
+
+    def _run_batch(self, compiled, var, start, stop, deadline):
+        """Blocking; runs in the math thread pool. MathError once time.monotonic() passes deadline."""
+        step = 1 if stop >= start else -1
+        if compiled.numexpr is not None:
+            import numexpr   # deferred: pulls in NumPy
+            import numpy
+            xs = numpy.arange(start, stop + step, step, dtype=numpy.float64)
+            with numpy.errstate(all="ignore"):
+                values = numpy.broadcast_to(numexpr.evaluate(compiled.numexpr, local_dict={var: xs, **MATH_CONSTS}),
+                                            xs.shape)
+            exact_ints = compiled.has_pow and bool((values == numpy.floor(values)).all())   # scalar ** gives ints
+            if (numpy.isfinite(values).all() and not (numpy.abs(values) >= MATH_EXACT_LIMIT).any()
+                    and not exact_ints):
+                self.vectorized += 1
+                return values.tolist()
+        values = []
+        for i, v in enumerate(range(start, stop + step, step)):
+            if i % MATH_CLOCK_EVERY == 0 and time.monotonic() > deadline:
+                raise _MathTimeout()
+            values.append(self._eval(compiled, {var: v}))
+        return values
+
+    async def _batch(self, expr, var, start, stop):
+        compiled = self.compile(expr, var)
+        if compiled is None:
+            return None
+        if abs(stop - start) + 1 > self.max_batch:
+            raise MathError(f"zyada se zyada {self.max_batch} values")
+        if self._executor is None:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="math")
+        self.batches += 1
+        loop = asyncio.get_running_loop()
+        deadline = time.monotonic() + self.timeout
+        try:
+            # the thread stops itself at the deadline; wait_for only backs up the numexpr call
+            values = await asyncio.wait_for(
+                loop.run_in_executor(self._executor, self._run_batch, compiled, var, start, stop, deadline),
+                self.timeout + 1.0)
+        except (asyncio.TimeoutError, _MathTimeout):
+            self.timeouts += 1
+            raise MathError("calculation me bahut time lag raha hai")
+        return values
+
+    @staticmethod
+    def _batch_text(var, start, stop, values):
+        step = 1 if stop >= start else -1
+        text = "\n".join(f"{var}={start + i * step} → {_format_number(v)}" for i, v in enumerate(values[:MATH_MAX_SHOWN]))
+        if len(values) > MATH_MAX_SHOWN:
+            finite = [v for v in values if isinstance(v, int) or (isinstance(v, float) and math.isfinite(v))]
+            text += f"\n… ({len(values)} values)"
+            if finite:
+                try:
+                    text += f"\nsum={_format_number(sum(finite) if all(isinstance(v, int) for v in finite) else math.fsum(finite))}"
+                except OverflowError:
+                    text += "\nsum=bahut bada"
+                text += f" min={_format_number(min(finite))} max={_format_number(max(finite))}"
+        return text
+
+    async def evaluate(self, query: str):
+        """HTML reply for a math query, or None when the query is not math."""
+        query = query.strip()
+        if not query or len(query) > MATH_MAX_LENGTH:
+            return None
+        parts = [p.strip() for p in query.split(";") if p.strip()]
+        if not parts or len(parts) > MATH_MAX_EXPRESSIONS:
+            return None
+        plans = []
+        for part in parts:
+            m = _MATH_BATCH.match(part)
+            if m:
+                var, start, stop = m.group("var"), int(m.group("start")), int(m.group("stop"))
+                if var in MATH_CONSTS or self.compile(m.group("expr"), var) is None:
+                    return None
+                plans.append((part, m.group("expr"), var, start, stop))
+            elif self.compile(part) is None:
+                return None
+            else:
+                plans.append((part, part, None, 0, 0))
+        lines = []
+        for label, expr, var, start, stop in plans:
+            shown = html.escape(label)
+            try:
+                if var is None:
+                    lines.append(f"🧮 <b>{shown} = {html.escape(_format_number(self._eval(self.compile(expr))))}</b>")
+                else:
+                    values = await self._batch(expr, var, start, stop)
+                    body = html.escape(self._batch_text(var, start, stop, values))
+                    lines.append(f"🧮 <b>{shown}</b>\n{body}")
+            except MathError as e:
+                self.errors += 1
+                lines.append(f"🧮 <b>{shown}</b> → ⚠️ {html.escape(str(e))}")
+        return "\n".join(lines)[:TELEGRAM_MAX_MESSAGE]
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "compiled": len(self._compiled), "batches": self.batches,
+                "vectorized": self.vectorized, "timeouts": self.timeouts, "errors": self.errors}
+
+math_engine = MathEngine(MATH_CACHE_SIZE, MATH_MAX_BATCH, MATH_TIMEOUT)
+
+async def safe_math(expr: str):
+    """HTML answer when `expr` is a math query (see MathEngine), else None."""
+    if not isinstance(expr, str):
         return None
+    return await math_engine.evaluate(expr)
 
-# ------------- Firebase usage helpers -------------
+# ------------- Quota storage backends -------------
 def _today_key():
     return datetime.date.today().isoformat()
 
@@ -107,75 +994,508 @@ def _month_key():
     d = datetime.date.today()
     return f"{d.year}-{d.month:02d}"
 
+class Increment:
+    """Write value meaning "atomically add n to this numeric leaf"."""
+
+    __slots__ = ("n",)
+
+    def __init__(self, n: int):
+        self.n = int(n)
+
+class FirebaseQuotaStore:
+    """Quota store on the Firebase Realtime Database REST API.
+
+    get(path) returns the JSON value (subtree) at path or None; update(values)
+    is one atomic multi-path PATCH at the DB root where each value is a JSON
+    value, None (delete) or Increment (server-side increment).
+    """
+
+    name = "firebase"
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+
+    async def get(self, path: str):
+        resp = await _async_get(f"{self.base_url}/{path}.json", service="firebase")
+        if resp.status_code == 200:
+            return resp.json()
+        return None
+
+    async def update(self, values: dict):
+        body = {path: {".sv": {"increment": v.n}} if isinstance(v, Increment) else v
+                for path, v in values.items()}
+        resp = await _async_request("PATCH", f"{self.base_url}/.json", service="firebase", json=body)
+        if resp.status_code != 200:
+            logger.warning("Firebase multi-path update failed (%s): %s", resp.status_code, resp.text[:200])
+            return False
+        return True
+
+    async def close(self):
+        pass
+
+class SQLiteQuotaStore:
+    """Quota store in a local SQLite file (WAL mode), same semantics as
+    FirebaseQuotaStore. The tree is kept as one row per leaf path, so a
+    subtree read is a primary-key range scan and increments are UPSERTs; each
+    update() runs in a single transaction. The async methods run on one
+    dedicated thread so a busy file never stalls the event loop."""
+
+    name = "sqlite"
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None,
+                                   timeout=SQLITE_BUSY_TIMEOUT)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="quota-sqlite")
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS kv (path TEXT PRIMARY KEY, value) WITHOUT ROWID")
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _flatten(path, value, out):
+        if isinstance(value, dict):
+            for k, v in value.items():
+                SQLiteQuotaStore._flatten(f"{path}/{k}", v, out)
+        elif value is not None:
+            out.append((path, value))
+        return out
+
+    def _delete_under(self, path, include_self=True):
+        if include_self:
+            self._db.execute("DELETE FROM kv WHERE path = ?", (path,))
+        self._db.execute("DELETE FROM kv WHERE path > ? AND path < ?", (path + "/", path + "0"))
+
+    def get_sync(self, path: str):
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT path, value FROM kv WHERE path = ? OR (path > ? AND path < ?)",
+                (path, path + "/", path + "0"),
+            ).fetchall()
+        tree = None
+        for p, v in rows:
+            if p == path:
+                return v
+            tree = {} if tree is None else tree
+            node = tree
+            keys = p[len(path) + 1:].split("/")
+            for k in keys[:-1]:
+                node = node.setdefault(k, {})
+            node[keys[-1]] = v
+        return tree
+
+    def update_sync(self, values: dict):
+        with self._lock:
+            try:
+                self._db.execute("BEGIN IMMEDIATE")
+                for path, value in values.items():
+                    parts = path.split("/")
+                    # a write below a scalar leaf replaces that leaf, as in Firebase
+                    self._db.executemany("DELETE FROM kv WHERE path = ?",
+                                         [("/".join(parts[:i]),) for i in range(1, len(parts))])
+                    if isinstance(value, Increment):
+                        self._delete_under(path, include_self=False)
+                        self._db.execute(
+                            "INSERT INTO kv (path, value) VALUES (?, ?) "
+                            "ON CONFLICT(path) DO UPDATE SET value = COALESCE(value, 0) + excluded.value",
+                            (path, value.n),
+                        )
+                    else:
+                        self._delete_under(path)
+                        self._db.executemany("INSERT INTO kv (path, value) VALUES (?, ?)",
+                                             self._flatten(path, value, []))
+                self._db.execute("COMMIT")
+                return True
+            except sqlite3.Error as e:
+                with contextlib.suppress(sqlite3.Error):
+                    self._db.execute("ROLLBACK")
+                logger.warning("SQLite quota update failed: %s", e)
+                return False
+
+    async def get(self, path: str):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.get_sync, path)
+
+    async def update(self, values: dict):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self.update_sync, values)
+
+    async def close(self):
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close)
+        self._executor.shutdown(wait=False)
+
+    def _close(self):
+        with self._lock:
+            self._db.close()
+
+def make_quota_store():
+    backend = QUOTA_BACKEND
+    if backend == "auto":
+        backend = "firebase" if FIREBASE_READY and FIREBASE_DB_URL else "sqlite"
+    if backend == "firebase":
+        store = FirebaseQuotaStore(FIREBASE_DB_URL)
+    else:
+        store = SQLiteQuotaStore(QUOTA_DB_PATH)
+    logger.info("Quota store: %s", store.name)
+    return store
+
+quota_store = make_quota_store()
+
+# ------------- Quota cache: LRU/TTL reads + coalesced write-back -------------
+class QuotaCache:
+    """Read cache and write-back buffer for the leaf quota paths under
+    /usage, /limits and /usage_images.
+
+    Reads return the cached server value with any unflushed local change
+    applied on top. Increments to the same path are coalesced and written as
+    one server-side increment per flush; flushes run on a timer (or inline
+    when no timer is running) and at shutdown. A flush moves its batch to
+    `_inflight`; cached values never include an in-flight write until it is
+    confirmed, and a read whose GET overlapped a flush (so it may or may not
+    include the write) is fetched again.
+
+    Paths under `shared` prefixes (set by shard workers, whose siblings write
+    the same store) are never cached and are written through on kick().
+    `on_invalidate(prefix, drop_pending)`, when set, is told about every
+    invalidate() so other processes can drop the same paths.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, flush_interval: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self._entries = OrderedDict()   # path -> (value, expires_at)
+        self._pending = {}              # path -> ["inc", delta] | ["set", value]
+        self._inflight = {}             # path -> ("inc", delta) | ("set", value) being written by flush()
+        self._flush_gen = 0             # bumped when a flush starts and when it ends
+        self._dirty_since = None
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+        self.shared = ()
+        self.on_invalidate = None
+        self._urgent = False
+        self.hits = 0
+        self.misses = 0
+        self.flushes = 0
+        self.flush_errors = 0
+        self.last_flush_lag = 0.0
+
+    @staticmethod
+    def _apply(base, op):
+        if op is None:
+            return base
+        if op[0] == "set":
+            return op[1]
+        return (base or 0) + op[1]
+
+    def _overlay(self, path, base):
+        return self._apply(self._apply(base, self._inflight.get(path)), self._pending.get(path))
+
+    def _store(self, path, value, expires_at):
+        self._entries[path] = (value, expires_at)
+        self._entries.move_to_end(path)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def _is_shared(self, path):
+        return any(path == p or path.startswith(p + "/") for p in self.shared)
+
+    async def read(self, paths):
+        now = time.monotonic()
+        found, missing = {}, []
+        for path in paths:
+            entry = None if self.shared and self._is_shared(path) else self._entries.get(path)
+            if entry is not None and entry[1] > now:
+                self._entries.move_to_end(path)
+                self.hits += 1
+                found[path] = entry[0]
+            else:
+                self.misses += 1
+                missing.append(path)
+        while missing:
+            if any(path in self._inflight for path in missing):
+                async with self._flush_lock:   # let the write land first so the GET sees it
+                    pass
+            gen = self._flush_gen
+            values = await asyncio.gather(*(quota_store.get(path) for path in missing))
+            if gen != self._flush_gen or any(path in self._inflight for path in missing):
+                continue   # a flush overlapped the GET: it may or may not include that write
+            expires_at = time.monotonic() + self.ttl
+            for path, value in zip(missing, values):
+                if not (self.shared and self._is_shared(path)):
+                    self._store(path, value, expires_at)
+                found[path] = value
+            break
+        return {path: self._overlay(path, found[path]) for path in paths}
+
+    def _mark_dirty(self, path):
+        if self._dirty_since is None:
+            self._dirty_since = time.monotonic()
+        if self.shared and self._is_shared(path):
+            self._urgent = True
+
+    def increment(self, path: str, n: int):
+        op = self._pending.get(path)
+        if op is None:
+            self._pending[path] = ["inc", n]
+        else:
+            op[1] += n
+        self._mark_dirty(path)
+
+    def set(self, path: str, value):
+        self._pending[path] = ["set", value]
+        self._mark_dirty(path)
+
+    def invalidate(self, prefix: str, drop_pending: bool = True, announce: bool = True):
+        """Drop cached values (and, by default, unflushed changes) for every path under prefix."""
+        for store in (self._entries, self._pending, self._inflight) if drop_pending else (self._entries,):
+            for path in [p for p in store if p == prefix or p.startswith(prefix + "/")]:
+                del store[path]
+        if not self._pending:
+            self._dirty_since = None
+        if announce and self.on_invalidate is not None:
+            self.on_invalidate(prefix, drop_pending)
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._pending:
+                return True
+            batch = {path: tuple(op) for path, op in self._pending.items()}
+            self._inflight, self._pending = batch, {}
+            self._flush_gen += 1
+            self._urgent = False
+            lag = time.monotonic() - (self._dirty_since or time.monotonic())
+            values = {path: Increment(v) if kind == "inc" else v for path, (kind, v) in batch.items()}
+            try:
+                ok = await quota_store.update(values)
+            except Exception as e:
+                logger.warning("Quota flush failed: %s", e)
+                ok = False
+            unwritten, self._inflight = self._inflight, {}   # minus anything invalidate() dropped meanwhile
+            self._flush_gen += 1
+            if not ok:
+                # put the batch back under whatever changed meanwhile
+                for path, (kind, v) in unwritten.items():
+                    op = self._pending.get(path)
+                    if op is None:
+                        self._pending[path] = [kind, v]
+                    elif op[0] == "inc":
+                        self._pending[path] = [kind, v + op[1]]
+                    self._mark_dirty(path)
+                self.flush_errors += 1
+                return False
+            for path, (kind, v) in batch.items():
+                entry = self._entries.get(path)
+                if entry is not None:   # cached before the flush started, so without this write
+                    self._entries[path] = (self._apply(entry[0], (kind, v)), entry[1])
+            self._dirty_since = time.monotonic() if self._pending else None
+            self.flushes += 1
+            self.last_flush_lag = lag
+            return True
+
+    async def kick(self):
+        """Write through when no background flusher is running or a shared path changed."""
+        if self._urgent or self._task is None or self._task.done():
+            await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception("Quota flusher error: %s", e)
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+        await self.flush()
+
+    def stats(self):
+        lag = time.monotonic() - self._dirty_since if self._dirty_since else 0.0
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "size": len(self._entries),
+            "pending": len(self._pending) + len(self._inflight),
+            "flushes": self.flushes,
+            "flush_errors": self.flush_errors,
+            "flush_lag": round(lag, 3),
+            "last_flush_lag": round(self.last_flush_lag, 3),
+        }
+
+quota_cache = QuotaCache(QUOTA_CACHE_SIZE, QUOTA_CACHE_TTL, QUOTA_FLUSH_INTERVAL)
+
+def _day_path(user_id: str):
+    return f"usage/{user_id}/{_today_key()}"
+
+def _limit_path(user_id: str):
+    return f"limits/{user_id}/daily"
+
+def _month_total_path():
+    return f"usage_images/{_month_key()}/total_count"
+
 async def get_usage(user_id: str):
     """Return dict with 'count' and 'last_ts' for today for given user."""
-    if not FIREBASE_READY:
-        return {"count": 0, "last_ts": 0.0}
-    url = f"{FIREBASE_DB_URL}/usage/{user_id}/{_today_key()}.json"
-    resp = await _async_get(url)
-    if resp.status_code == 200 and resp.json():
-        data = resp.json()
-        return {"count": int(data.get("count", 0)), "last_ts": float(data.get("last_ts", 0.0))}
-    return {"count": 0, "last_ts": 0.0}
+    day = _day_path(user_id)
+    vals = await quota_cache.read([f"{day}/count", f"{day}/last_ts"])
+    return {"count": int(vals[f"{day}/count"] or 0), "last_ts": float(vals[f"{day}/last_ts"] or 0.0)}
 
 async def set_usage(user_id: str, count: int, last_ts: float):
-    if not FIREBASE_READY:
+    day = _day_path(user_id)
+    quota_cache.set(f"{day}/count", int(count))
+    quota_cache.set(f"{day}/last_ts", float(last_ts))
+    await quota_cache.kick()
+
+async def get_quota_snapshot(user_id: str):
+    """Today's usage, daily limit and monthly total for a user in one (cached) read."""
+    day, limit_path, month_path = _day_path(user_id), _limit_path(user_id), _month_total_path()
+    vals = await quota_cache.read([f"{day}/count", f"{day}/last_ts", limit_path, month_path])
+    return {
+        "count": int(vals[f"{day}/count"] or 0),
+        "last_ts": float(vals[f"{day}/last_ts"] or 0.0),
+        "limit": int(vals[limit_path]) if vals[limit_path] is not None else DEFAULT_DAILY_LIMIT,
+        "monthly_total": int(vals[month_path] or 0),
+    }
+
+async def commit_image_usage(user_id: str, images: int = 1, last_ts: float | None = None, monthly: bool = True):
+    """Bump the user's daily count and (unless monthly=False, e.g. for cached
+    images that cost no Vertex call) the monthly total by `images` (negative to
+    refund) and optionally stamp last_ts. Buffered in the quota cache and
+    written as one atomic multi-path update on the next flush."""
+    day = _day_path(user_id)
+    quota_cache.increment(f"{day}/count", images)
+    if monthly:
+        quota_cache.increment(_month_total_path(), images)
+    # aggregates read by /stats
+    today = _today_key()
+    daily_stats = f"stats/daily/{today}"
+    quota_cache.increment(f"{daily_stats}/total", images)
+    quota_cache.increment(f"stats/monthly/{_month_key()}/total", images)
+    if last_ts is not None:
+        quota_cache.set(f"{day}/last_ts", float(last_ts))
+    count = int((await quota_cache.read([f"{day}/count"]))[f"{day}/count"] or 0)
+    if (count > 0) != (count - images > 0):
+        quota_cache.increment(f"{daily_stats}/active", 1 if count > 0 else -1)
+    await _note_daily_top(today, user_id, count)
+    await quota_cache.kick()
+
+_daily_top = {"day": None, "top": {}}
+
+async def _note_daily_top(day: str, user_id: str, count: int):
+    """Keep stats/daily/<day>/top at the STATS_TOP_USERS heaviest users.
+
+    Tracked per process, so with several instances it is approximate until
+    the next /compactstats rewrites it exactly.
+    """
+    if _daily_top["day"] != day:
+        cur = await quota_store.get(f"stats/daily/{day}/top")
+        _daily_top.update(day=day, top={uid: int(c) for uid, c in cur.items()} if isinstance(cur, dict) else {})
+    top = _daily_top["top"]
+    if user_id not in top and (count <= 0 or (len(top) >= STATS_TOP_USERS and count <= min(top.values()))):
         return
-    url = f"{FIREBASE_DB_URL}/usage/{user_id}/{_today_key()}.json"
-    await _async_put(url, json={"count": int(count), "last_ts": float(last_ts)})
+    top[user_id] = count
+    while top and (len(top) > STATS_TOP_USERS or min(top.values()) <= 0):
+        low = min(top, key=top.get)
+        del top[low]
+        quota_cache.set(f"stats/daily/{day}/top/{low}", None)
+    if user_id in top:
+        quota_cache.set(f"stats/daily/{day}/top/{user_id}", count)
+
+async def get_daily_stats(day: str | None = None):
+    """Precomputed {"total", "active", "users": top {uid: count}} for a day (default today)."""
+    await quota_cache.flush()
+    data = await quota_store.get(f"stats/daily/{day or _today_key()}")
+    if not isinstance(data, dict):
+        return {"total": 0, "active": 0, "users": {}}
+    # nodes written before the top-N change carry the full per-user map
+    legacy = data.get("users") if isinstance(data.get("users"), dict) else {}
+    top = data.get("top") if isinstance(data.get("top"), dict) else legacy
+    users = dict(sorted(((uid, int(c)) for uid, c in top.items() if c), key=lambda kv: kv[1], reverse=True)[:STATS_TOP_USERS])
+    return {"total": int(data.get("total", 0)), "active": int(data.get("active") or len(legacy)), "users": users}
+
+async def get_monthly_stats(month: str | None = None):
+    data = await quota_store.get(f"stats/monthly/{month or _month_key()}/total")
+    return int(data or 0)
+
+async def compact_usage(keep_days: int = STATS_KEEP_DAYS, batch: int = 500):
+    """Rebuild stats/daily + stats/monthly from /usage plus /usage_archive and
+    move per-day user records older than keep_days to /usage_archive/<day>/<uid>.
+
+    Reads both trees once, so run it rarely (admin /compactstats).
+    Aggregates are overwritten with the recomputed values; increments that land
+    while it runs can be lost for the current day/month.
+    """
+    await quota_cache.flush()
+    data = await quota_store.get("usage")
+    archive = await quota_store.get("usage_archive")
+    data = data if isinstance(data, dict) else {}
+    archive = archive if isinstance(archive, dict) else {}
+    cutoff = (datetime.date.today() - datetime.timedelta(days=keep_days)).isoformat()
+    counts, values = {}, {}   # (day, uid) -> count; live records win over a half-finished archive
+    archived = 0
+    for day, users in archive.items():
+        for uid, rec in (users.items() if isinstance(users, dict) else ()):
+            counts[(day, uid)] = int(rec.get("count", 0)) if isinstance(rec, dict) else 0
+    for uid, dates in data.items():
+        if not isinstance(dates, dict):
+            continue
+        for day, rec in dates.items():
+            counts[(day, uid)] = int(rec.get("count", 0)) if isinstance(rec, dict) else 0
+            if day < cutoff:
+                values[f"usage_archive/{day}/{uid}"] = rec
+                values[f"usage/{uid}/{day}"] = None
+                archived += 1
+    daily, monthly = {}, {}
+    for (day, uid), count in counts.items():
+        if count:
+            daily.setdefault(day, {})[uid] = count
+            monthly[day[:7]] = monthly.get(day[:7], 0) + count
+    for day, users in daily.items():
+        top = sorted(users.items(), key=lambda kv: kv[1], reverse=True)[:STATS_TOP_USERS]
+        values[f"stats/daily/{day}"] = {"total": sum(users.values()), "active": len(users), "top": dict(top)}
+    for month, total in monthly.items():
+        values[f"stats/monthly/{month}/total"] = total
+    items = list(values.items())
+    for i in range(0, len(items), batch):
+        if not await quota_store.update(dict(items[i:i + batch])):
+            raise RuntimeError("Quota store update failed during compaction")
+    quota_cache.invalidate("usage", drop_pending=False)
+    quota_cache.invalidate("stats", drop_pending=False)
+    _daily_top["day"] = None
+    return {"users": len(data), "days": len(daily), "archived": archived}
 
 async def increment_usage(user_id: str):
     """Increment user's daily count and monthly global total."""
-    if not FIREBASE_READY:
-        return
-    # increment daily count
-    day_count_url = f"{FIREBASE_DB_URL}/usage/{user_id}/{_today_key()}/count.json"
-    resp = await _async_get(day_count_url)
-    cur = 0
-    if resp.status_code == 200 and resp.json() is not None:
-        cur = int(resp.json())
-    await _async_put(day_count_url, json=cur + 1)
-    # update last_ts
-    ts_url = f"{FIREBASE_DB_URL}/usage/{user_id}/{_today_key()}/last_ts.json"
-    await _async_put(ts_url, json=time.time())
-    # increment monthly total
-    month_key = _month_key()
-    month_url = f"{FIREBASE_DB_URL}/usage_images/{month_key}/total_count.json"
-    resp2 = await _async_get(month_url)
-    curm = 0
-    if resp2.status_code == 200 and resp2.json() is not None:
-        curm = int(resp2.json())
-    await _async_put(month_url, json=curm + 1)
+    await commit_image_usage(user_id, 1, time.time())
 
 async def get_daily_limit(user_id: str):
-    if not FIREBASE_READY:
-        return DEFAULT_DAILY_LIMIT
-    url = f"{FIREBASE_DB_URL}/limits/{user_id}/daily.json"
-    resp = await _async_get(url)
-    if resp.status_code == 200 and resp.json() is not None:
-        return int(resp.json())
-    return DEFAULT_DAILY_LIMIT
+    path = _limit_path(user_id)
+    val = (await quota_cache.read([path]))[path]
+    return int(val) if val is not None else DEFAULT_DAILY_LIMIT
+
+async def set_daily_limit(user_id: str, n: int):
+    await quota_store.update({_limit_path(user_id): int(n)})
+    quota_cache.invalidate(_limit_path(user_id))
 
 async def get_monthly_total():
-    if not FIREBASE_READY:
-        return 0
-    url = f"{FIREBASE_DB_URL}/usage_images/{_month_key()}/total_count.json"
-    resp = await _async_get(url)
-    if resp.status_code == 200 and resp.json() is not None:
-        return int(resp.json())
-    return 0
+    path = _month_total_path()
+    return int((await quota_cache.read([path]))[path] or 0)
 
 async def reset_monthly_total():
-    if not FIREBASE_READY:
-        return
-    url = f"{FIREBASE_DB_URL}/usage_images/{_month_key()}/total_count.json"
-    await _async_put(url, json=0)
+    quota_cache.invalidate(_month_total_path())
+    await quota_store.update({_month_total_path(): 0})
 
 async def reset_user_daily(user_id: str):
-    if not FIREBASE_READY:
-        return
-    url = f"{FIREBASE_DB_URL}/usage/{user_id}/{_today_key()}.json"
-    await _async_put(url, json={"count": 0, "last_ts": 0.0})
+    quota_cache.invalidate(_day_path(user_id))
+    await quota_store.update({_day_path(user_id): {"count": 0, "last_ts": 0.0}})
+    # again once written: a read during the update (here or in a shard sibling) may have cached the old count
+    quota_cache.invalidate(_day_path(user_id), drop_pending=False)
 
 # ------------- Parse image args -------------
 def parse_image_args(args_list):
@@ -183,6 +1503,12 @@ def parse_image_args(args_list):
     size = None
     seed = None
     negative = None
+    n = 1
+
+    m = re.search(r"--n\s+(\d+)", text)
+    if m:
+        n = max(1, min(IMAGE_MAX_SAMPLES, int(m.group(1))))
+        text = re.sub(r"--n\s+\d+", "", text)
 
     m = re.search(r"--size\s+(512|768|1024)", text)
     if m:
@@ -199,22 +1525,262 @@ def parse_image_args(args_list):
         negative = m.group(1).strip()
         text = re.sub(r"--no\s+[^\n]+", "", text)
 
-    return text.strip(), size, seed, negative
+    return text.strip(), size, seed, negative, n
+
+# ------------- Image pipeline: streamed decode, byte budget, re-encode -------------
+IMAGE_SIZE_ESTIMATE = {"512": 512 * 1024, "768": 1024 * 1024, "1024": 2 * 1024 * 1024}   # decoded PNG, rough
+_B64_VALUE_START = re.compile(rb'"(?:bytesBase64Encoded|b64|imageBytes)"\s*:\s*"')
+
+class ImageByteBudget:
+    """Caps the decoded image bytes held by all /image jobs at once.
+
+    reserve() waits in FIFO order until the estimate fits, so a burst queues
+    instead of growing RSS; a reservation is always admitted when nothing else
+    is held, so one oversized batch cannot wait forever.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self.peak = 0
+        self.waited = 0
+        self._waiters = deque()
+
+    def _take(self, n: int):
+        self.in_use += n
+        self.peak = max(self.peak, self.in_use)
+
+    def _fits(self, n: int):
+        return not self.in_use or self.in_use + n <= self.limit
+
+    async def reserve(self, n: int):
+        if not self._waiters and self._fits(n):
+            self._take(n)
+            return n
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append((n, fut))
+        self.waited += 1
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release(n)    # granted just as we were cancelled
+            else:
+                self._wake()
+            raise
+        return n
+
+    def adjust(self, old: int, new: int):
+        """Swap an estimate for the real size (never waits)."""
+        self._take(new - old)
+        if new < old:
+            self._wake()
+
+    def release(self, n: int):
+        self.in_use -= n
+        self._wake()
+
+    def _wake(self):
+        while self._waiters:
+            n, fut = self._waiters[0]
+            if fut.done():
+                self._waiters.popleft()
+                continue
+            if not self._fits(n):
+                return
+            self._waiters.popleft()
+            self._take(n)
+            fut.set_result(None)
+
+    def stats(self):
+        return {"in_use": self.in_use, "peak": self.peak, "limit": self.limit,
+                "waiting": sum(1 for _, fut in self._waiters if not fut.done()), "waited": self.waited}
+
+image_bytes_budget = ImageByteBudget(IMAGE_INFLIGHT_MAX_BYTES)
+
+class B64ImageStream:
+    """Pulls base64 image strings out of a JSON body as it streams in.
+
+    feed() takes raw response chunks; every image value is decoded 4 bytes at a
+    time straight into its own SpooledTemporaryFile, so neither the JSON text
+    nor the base64 string is ever held whole.
+    """
+
+    def __init__(self, max_images: int, spool_max: int):
+        self.max_images = max_images
+        self.spool_max = spool_max
+        self.files = []
+        self.total = 0
+        self._buf = b""
+        self._carry = b""
+        self._in_value = False
+
+    def feed(self, chunk: bytes):
+        data = self._buf + chunk
+        self._buf = b""
+        while data:
+            if not self._in_value:
+                if len(self.files) >= self.max_images:
+                    return
+                m = _B64_VALUE_START.search(data)
+                if m is None:
+                    self._buf = data[-64:]    # a key may straddle chunks
+                    return
+                self.files.append(tempfile.SpooledTemporaryFile(max_size=self.spool_max))
+                self._in_value = True
+                data = data[m.end():]
+                continue
+            end = data.find(b'"')
+            part = data if end < 0 else data[:end]
+            if end < 0 and part.endswith(b"\\"):
+                part, self._buf = part[:-1], b"\\"   # half of an escaped "\/"
+            self._write(part.replace(b"\\/", b"/"))
+            if end < 0:
+                return
+            self._finish()
+            data = data[end + 1:]
+
+    def _write(self, part: bytes, final: bool = False):
+        part = self._carry + part
+        cut = len(part) if final else len(part) - len(part) % 4
+        self._carry = part[cut:]
+        if cut:
+            decoded = base64.b64decode(part[:cut] + b"=" * (-cut % 4))
+            self.files[-1].write(decoded)
+            self.total += len(decoded)
+
+    @property
+    def complete(self):
+        """At least one image, and the body did not end inside one."""
+        return bool(self.files) and not self._in_value
+
+    def _finish(self):
+        self._write(b"", final=True)
+        self.files[-1].seek(0)
+        self._in_value = False
+
+    def close(self):
+        for f in self.files:
+            f.close()
+        self.files = []
+
+class ImageBatch:
+    """Generated images as seekable file objects, plus their share of the
+    in-flight byte budget; close() frees both."""
+
+    __slots__ = ("files", "reserved")
+
+    def __init__(self, files: list, reserved: int = 0):
+        self.files = files
+        self.reserved = reserved
+
+    def __len__(self):
+        return len(self.files)
+
+    def close(self):
+        for f in self.files:
+            with contextlib.suppress(Exception):
+                f.close()
+        self.files = []
+        if self.reserved:
+            image_bytes_budget.release(self.reserved)
+            self.reserved = 0
+
+@functools.lru_cache(maxsize=None)
+def _pil_image():
+    """PIL.Image when Pillow is installed (optional, only for re-encoding)."""
+    try:
+        from PIL import Image
+    except ImportError:
+        logger.warning("IMAGE_UPLOAD_FORMAT=%s needs Pillow; uploading PNGs as generated", IMAGE_UPLOAD_FORMAT)
+        return None
+    return Image
+
+def _reencode(src, fmt: str, quality: int):
+    """Blocking: PNG file object -> spooled JPEG/WebP file object."""
+    Image = _pil_image()
+    with Image.open(src) as img:
+        if fmt == "jpeg" and img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        out = tempfile.SpooledTemporaryFile(max_size=IMAGE_SPOOL_MAX_MEMORY)
+        img.save(out, format=fmt.upper(), quality=quality)
+    out.seek(0)
+    return out
+
+async def prepare_uploads(files: list):
+    """(file object, filename) pairs ready for Telegram. Photos are re-encoded to
+    IMAGE_UPLOAD_FORMAT when Pillow is available; documents stay original PNGs.
+    Re-encoded files replace their sources in `files` so the owner closes them."""
+    fmt = IMAGE_UPLOAD_FORMAT if IMAGE_UPLOAD_FORMAT in ("jpeg", "jpg", "webp") else "png"
+    fmt = "jpeg" if fmt == "jpg" else fmt
+    if IMAGE_DELIVERY == "document" or fmt == "png" or _pil_image() is None:
+        return [(f, f"ai_image_{i + 1}.png") for i, f in enumerate(files)]
+    loop = asyncio.get_running_loop()
+    encoded = await asyncio.gather(*(loop.run_in_executor(None, _reencode, f, fmt, IMAGE_UPLOAD_QUALITY)
+                                     for f in files), return_exceptions=True)
+    out = []
+    for i, (src, enc) in enumerate(zip(list(files), encoded)):
+        if isinstance(enc, Exception):
+            logger.warning("Re-encode failed, sending PNG: %s", enc)
+            src.seek(0)
+            out.append((src, f"ai_image_{i + 1}.png"))
+            continue
+        src.close()
+        files[i] = enc
+        out.append((enc, f"ai_image_{i + 1}.{'jpg' if fmt == 'jpeg' else fmt}"))
+    return out
 
 # ------------- Vertex AI image generation (REST) -------------
 SIZE_MAP = {"512": "512x512", "768": "768x768", "1024": "1024x1024"}
 
-async def vertex_generate_image(prompt: str, size: str | None = None, seed: int | None = None, negative: str | None = None):
+def _vertex_url(location: str):
+    return (
+        f"{VERTEX_BASE_URL.format(location=location)}/v1/projects/"
+        f"{VERTEX_PROJECT_ID}/locations/{location}/publishers/google/models/imagegeneration:predict?key={GEMINI_API_KEY}"
+    )
+
+async def _vertex_predict(payload: dict, headers: dict, n: int):
+    """Stream the predict response into a B64ImageStream. Starts at VERTEX_LOCATION
+    and moves on to VERTEX_FALLBACK_LOCATIONS when a region's breaker is open or
+    it keeps failing; one deadline covers all of them. None when every region failed."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + VERTEX_DEADLINE
+    locations = [VERTEX_LOCATION] + [l for l in VERTEX_FALLBACK_LOCATIONS if l != VERTEX_LOCATION]
+    for i, location in enumerate(locations):
+        # the caller paid for the first region; a fallback is one more Vertex call
+        if (i and resilience.available(f"vertex:{location}")
+                and not await resilience.charge("vertex", deadline - loop.time())):
+            break
+        sink = B64ImageStream(n, IMAGE_SPOOL_MAX_MEMORY)
+        try:
+            async with resilience.stream("vertex", "POST", _vertex_url(location), breaker=f"vertex:{location}",
+                                         deadline=deadline, json=payload, headers=headers) as resp:
+                resp.raise_for_status()
+                async for chunk in resp.aiter_bytes(64 * 1024):
+                    sink.feed(chunk)
+            return sink
+        except UpstreamUnavailable as e:
+            logger.warning("Vertex %s skipped: %s", location, e.reason)
+        except httpx.HTTPStatusError as e:
+            if e.response.status_code not in RETRYABLE_STATUS:
+                raise
+            logger.warning("Vertex %s answered %s, trying next location", location, e.response.status_code)
+        except BaseException:
+            sink.close()
+            raise
+        sink.close()
+    return None
+
+async def vertex_generate_image(prompt: str, size: str | None = None, seed: int | None = None,
+                                negative: str | None = None, n: int = 1):
+    """ImageBatch of up to `n` PNGs from one predict call, or None. Vertex may
+    return fewer samples than asked (e.g. some filtered for safety). The caller
+    must close() the batch once the images are sent."""
     if not (VERTEX_PROJECT_ID and GEMINI_API_KEY and VERTEX_LOCATION):
         logger.error("Vertex configuration missing")
         return None
 
-    url = (
-        f"https://{VERTEX_LOCATION}-aiplatform.googleapis.com/v1/projects/"
-        f"{VERTEX_PROJECT_ID}/locations/{VERTEX_LOCATION}/publishers/google/models/imagegeneration:predict?key={GEMINI_API_KEY}"
-    )
-
-    parameters = {"sampleCount": 1, "imageSize": SIZE_MAP.get(size or "1024", "1024x1024")}
+    parameters = {"sampleCount": n, "imageSize": SIZE_MAP.get(size or "1024", "1024x1024")}
     if seed is not None:
         parameters["seed"] = int(seed)
 
@@ -226,156 +1792,1219 @@ async def vertex_generate_image(prompt: str, size: str | None = None, seed: int
     payload = {"instances": [{"prompt": final_prompt}], "parameters": parameters}
     headers = {"Content-Type": "application/json"}
 
+    # global Vertex budget shared by all users
+    if not await rate_limiter.acquire("vertex", max_wait=30):
+        logger.warning("Vertex rate budget exhausted, skipping generation")
+        return None
+
+    # hold an estimate of the decoded size against the global in-flight cap
+    estimate = n * IMAGE_SIZE_ESTIMATE.get(size or "1024", IMAGE_SIZE_ESTIMATE["1024"])
+    await image_bytes_budget.reserve(estimate)
+    sink = None
     try:
-        resp = await _async_post(url, json=payload, headers=headers, timeout=120)
-        resp.raise_for_status()
-        data = resp.json()
-        # common key:
-        enc = None
-        if isinstance(data.get("predictions"), list) and data["predictions"]:
-            pred = data["predictions"][0]
-            enc = pred.get("bytesBase64Encoded") or pred.get("b64") or pred.get("imageBytes") or None
-            if not enc:
-                # search for string-like value
-                for v in pred.values():
-                    if isinstance(v, str) and len(v) > 100:
-                        enc = v
-                        break
-        if not enc:
-            logger.error("No base64 image in Vertex response: %s", data)
+        sink = await _vertex_predict(payload, headers, n)
+        if sink is None:
+            image_bytes_budget.release(estimate)
             return None
-        return base64.b64decode(enc)
-    except Exception as e:
+        if not sink.complete:
+            logger.error("No (complete) base64 image in Vertex response")
+            sink.close()
+            image_bytes_budget.release(estimate)
+            return None
+        image_bytes_budget.adjust(estimate, sink.total)
+        return ImageBatch(sink.files, sink.total)
+    except BaseException as e:
+        if sink is not None:
+            sink.close()
+        image_bytes_budget.release(estimate)
+        if not isinstance(e, Exception):
+            raise
         logger.exception("Vertex image generation failed: %s", e)
         return None
 
-# ------------- Cooldown check (per-user via Firebase last_ts) -------------
-async def check_and_update_cooldown(user_id: str, min_gap: int = COOLDOWN_SECONDS):
-    usage = await get_usage(user_id)
-    now = time.time()
-    last = usage.get("last_ts", 0.0)
-    if now - last < min_gap:
-        return False
-    # update last_ts (without incrementing count)
-    await set_usage(user_id, usage.get("count", 0), now)
-    return True
+# ------------- Seeded image cache (content-addressed) -------------
+class ImageCache:
+    """Cache for /image requests with an explicit seed, keyed by a hash of the
+    full parse_image_args() output (same inputs -> same image).
+
+    Keeps the Telegram file_id of the first upload so repeats are a plain
+    resend, and optionally the PNG bytes in a size-capped directory with LRU
+    (mtime) eviction so a lost file_id never needs a new generation.
+    """
+
+    def __init__(self, maxsize: int, directory: str | None = None, dir_max_bytes: int = 0):
+        self.maxsize = maxsize
+        self.directory = directory
+        self.dir_max_bytes = dir_max_bytes
+        self._file_ids = OrderedDict()
+        self._files = OrderedDict()     # key -> size, oldest first
+        self._dir_bytes = 0
+        self.hits = 0
+        self.byte_hits = 0
+        self.misses = 0
+        if directory:
+            try:
+                os.makedirs(directory, exist_ok=True)
+                entries = []
+                for name in os.listdir(directory):
+                    if name.endswith(".png"):
+                        st = os.stat(os.path.join(directory, name))
+                        entries.append((st.st_mtime, name[:-4], st.st_size))
+                for _, key, size in sorted(entries):
+                    self._files[key] = size
+                    self._dir_bytes += size
+            except OSError as e:
+                logger.warning("Image cache dir disabled: %s", e)
+                self.directory = None
+
+    @staticmethod
+    def keys(parsed):
+        """One cache key per requested sample of a parse_image_args() result,
+        or None when unseeded. Single images keep their pre-`--n` keys."""
+        if parsed[2] is None:
+            return None
+        n = parsed[4]
+        digest = hashlib.sha256(json.dumps(list(parsed[:4] if n == 1 else parsed)).encode()).hexdigest()
+        return [digest] if n == 1 else [f"{digest}-{i}" for i in range(n)]
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.png")
+
+    def get_file_id(self, key):
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            self._file_ids.move_to_end(key)
+        return file_id
+
+    def put_file_id(self, key, file_id: str):
+        self._file_ids[key] = file_id
+        self._file_ids.move_to_end(key)
+        while len(self._file_ids) > self.maxsize:
+            self._file_ids.popitem(last=False)
+
+    def drop_file_id(self, key):
+        self._file_ids.pop(key, None)
+
+    def get_file_ids(self, keys):
+        """All file_ids for `keys`, or None unless every one is cached."""
+        file_ids = [self.get_file_id(key) for key in keys]
+        return file_ids if all(file_ids) else None
+
+    def open_files(self, keys):
+        """Open files for all `keys`, or None unless every one is cached."""
+        files = []
+        for key in keys:
+            f = self.open_file(key)
+            if f is None:
+                for opened in files:
+                    opened.close()
+                return None
+            files.append(f)
+        return files
+
+    def open_file(self, key):
+        """Open binary file for a cached image (caller closes it), or None."""
+        if not self.directory or key not in self._files:
+            return None
+        try:
+            f = open(self._path(key), "rb")
+            os.utime(self._path(key))
+        except OSError:
+            self._dir_bytes -= self._files.pop(key)
+            return None
+        self._files.move_to_end(key)
+        return f
+
+    def put_file(self, key, src):
+        """Copy a seekable file object into the cache dir (src is rewound afterwards)."""
+        if not self.directory:
+            return
+        size = src.seek(0, os.SEEK_END)
+        src.seek(0)
+        if size > self.dir_max_bytes:
+            return
+        tmp = self._path(key) + ".tmp"
+        try:
+            with open(tmp, "wb") as f:
+                shutil.copyfileobj(src, f, 256 * 1024)
+            os.replace(tmp, self._path(key))
+        except OSError as e:
+            logger.warning("Image cache write failed: %s", e)
+            return
+        finally:
+            src.seek(0)
+        self._dir_bytes += size - self._files.pop(key, 0)
+        self._files[key] = size
+        while self._dir_bytes > self.dir_max_bytes and self._files:
+            old, size = self._files.popitem(last=False)
+            self._dir_bytes -= size
+            with contextlib.suppress(OSError):
+                os.remove(self._path(old))
+
+    def stats(self):
+        return {"hits": self.hits, "byte_hits": self.byte_hits, "misses": self.misses,
+                "file_ids": len(self._file_ids), "files": len(self._files), "bytes": self._dir_bytes}
+
+image_cache = ImageCache(IMAGE_CACHE_SIZE, IMAGE_CACHE_DIR, IMAGE_CACHE_DIR_MAX_BYTES)
+
+# ------------- Rate limiting (local token buckets) -------------
+class TokenBuckets:
+    """Token buckets for many keys sharing one (rate, burst) setting.
+
+    Bucket state lives in two flat float arrays indexed through a key -> slot
+    OrderedDict kept in least-recently-used order (~190 bytes per key, mostly
+    the dict entry and the key object). A bucket that has refilled to `burst`
+    is the same as a fresh one, so each call also drops up to SWEEP_BATCH idle
+    keys from the cold end; at `max_keys` the least recently used key is
+    evicted outright (that user just gets a fresh bucket). No call ever scans
+    the whole table.
+    """
+
+    SWEEP_BATCH = 4
+
+    def __init__(self, rate: float, burst: float, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._slots = OrderedDict()
+        self._tokens = array("d")
+        self._stamps = array("d")
+        self._free = []
+        self.evicted = 0
+
+    def _alloc(self):
+        if self._free:
+            return self._free.pop()
+        self._tokens.append(0.0)
+        self._stamps.append(0.0)
+        return len(self._tokens) - 1
+
+    def try_acquire(self, key, cost: float = 1.0):
+        """Take `cost` tokens; return 0.0 on success, else seconds until enough refill."""
+        now = time.monotonic()
+        self.sweep(now)
+        slot = self._slots.get(key)
+        if slot is None:
+            if len(self._slots) >= self.max_keys:
+                self._free.append(self._slots.popitem(last=False)[1])
+                self.evicted += 1
+            slot = self._slots[key] = self._alloc()
+            tokens = self.burst
+        else:
+            self._slots.move_to_end(key)
+            tokens = min(self.burst, self._tokens[slot] + (now - self._stamps[slot]) * self.rate)
+        self._stamps[slot] = now
+        if tokens >= cost:
+            self._tokens[slot] = tokens - cost
+            return 0.0
+        self._tokens[slot] = tokens
+        return (cost - tokens) / self.rate
+
+    def sweep(self, now: float | None = None, limit: int | None = None):
+        """Drop up to `limit` (default SWEEP_BATCH) refilled keys from the LRU end."""
+        now = time.monotonic() if now is None else now
+        dropped = 0
+        for _ in range(self.SWEEP_BATCH if limit is None else limit):
+            if not self._slots:
+                break
+            key, slot = next(iter(self._slots.items()))
+            if now - self._stamps[slot] < (self.burst - self._tokens[slot]) / self.rate:
+                break   # the coldest key is still refilling; everything after it was used later
+            del self._slots[key]
+            self._free.append(slot)
+            dropped += 1
+        return dropped
+
+    def __len__(self):
+        return len(self._slots)
+
+class SharedTokenBuckets:
+    """TokenBuckets kept in a SQLite file, so several processes (the sharded
+    polling workers) draw from the same buckets. Same try_acquire contract;
+    each call is one short BEGIN IMMEDIATE transaction. Wall-clock time is
+    used because monotonic clocks are not comparable across processes. If
+    the file is unusable the limit fails open rather than blocking users.
+    RateLimiter calls it on the shared executor thread, never the event loop."""
+
+    SWEEP_INTERVAL = 60.0
+
+    def __init__(self, db, lock, executor, name: str, rate: float, burst: float):
+        self._db = db
+        self._lock = lock
+        self.executor = executor
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self._last_sweep = time.time()
+
+    def try_acquire(self, key, cost: float = 1.0):
+        now = time.time()
+        if now - self._last_sweep > self.SWEEP_INTERVAL:
+            self.sweep(now)
+        key = "" if key is None else str(key)
+        with self._lock:
+            try:
+                self._db.execute("BEGIN IMMEDIATE")
+                row = self._db.execute("SELECT tokens, stamp FROM buckets WHERE name = ? AND key = ?",
+                                       (self.name, key)).fetchone()
+                tokens = self.burst if row is None else min(self.burst, row[0] + max(0.0, now - row[1]) * self.rate)
+                wait = 0.0 if tokens >= cost else (cost - tokens) / self.rate
+                if not wait:
+                    tokens -= cost
+                self._db.execute("INSERT OR REPLACE INTO buckets (name, key, tokens, stamp) VALUES (?, ?, ?, ?)",
+                                 (self.name, key, tokens, now))
+                self._db.execute("COMMIT")
+                return wait
+            except sqlite3.Error as e:
+                with contextlib.suppress(sqlite3.Error):
+                    self._db.execute("ROLLBACK")
+                logger.warning("Shared rate limit %s failed: %s", self.name, e)
+                return 0.0
+
+    def sweep(self, now: float | None = None):
+        now = time.time() if now is None else now
+        self._last_sweep = now
+        with self._lock:
+            cur = self._db.execute("DELETE FROM buckets WHERE name = ? AND tokens + (? - stamp) * ? >= ?",
+                                   (self.name, now, self.rate, self.burst))
+        return cur.rowcount
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM buckets WHERE name = ?", (self.name,)).fetchone()[0]
+
+class RateLimiter:
+    """Named bucket tables: per-user (key=user id) or global (key=None).
+    A rate <= 0 disables that limit."""
+
+    def __init__(self, limits: dict):
+        self._tables = {name: TokenBuckets(rate, burst) for name, (rate, burst) in limits.items() if rate > 0}
+
+    def share(self, db_path: str, local=()):
+        """Move every table except `local` into SharedTokenBuckets at db_path."""
+        db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None, timeout=SQLITE_BUSY_TIMEOUT)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT, key TEXT, tokens REAL, stamp REAL, "
+                   "PRIMARY KEY (name, key)) WITHOUT ROWID")
+        lock = threading.Lock()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="shared-limits")
+        for name, table in list(self._tables.items()):
+            if name not in local:
+                self._tables[name] = SharedTokenBuckets(db, lock, executor, name, table.rate, table.burst)
+
+    async def try_acquire(self, name: str, key=None, cost: float = 1.0):
+        table = self._tables.get(name)
+        if table is None:
+            return 0.0
+        if isinstance(key, str) and key.isdigit():
+            key = int(key)   # ints are far cheaper dict keys than strings
+        executor = getattr(table, "executor", None)
+        if executor is None:
+            return table.try_acquire(key, cost)
+        return await asyncio.get_running_loop().run_in_executor(executor, table.try_acquire, key, cost)
+
+    async def acquire(self, name: str, key=None, max_wait: float = 0.0, cost: float = 1.0):
+        """Wait (up to max_wait seconds) for tokens; False if they would not arrive in time."""
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = await self.try_acquire(name, key, cost)
+            if wait == 0.0:
+                return True
+            if time.monotonic() + wait > deadline:
+                return False
+            await asyncio.sleep(wait)
+
+    def stats(self):
+        return {name: len(table) for name, table in self._tables.items()}
+
+rate_limiter = RateLimiter({
+    "image": (1.0 / max(COOLDOWN_SECONDS, 0.001), 1),
+    "ask": (ASK_RATE_PER_MIN / 60.0, max(1, ASK_RATE_PER_MIN / 4)),
+    "search": (SEARCH_RATE_PER_MIN / 60.0, max(1, SEARCH_RATE_PER_MIN / 4)),
+    "vertex": (VERTEX_RPM / 60.0, max(1, VERTEX_RPM / 10)),
+    "gemini": (GEMINI_RPM / 60.0, max(1, GEMINI_RPM / 10)),
+    "tg_chat": (TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST),
+    "tg_group": (TELEGRAM_GROUP_PER_MIN / 60.0, max(1, TELEGRAM_GROUP_PER_MIN / 10)),
+    "tg_global": (TELEGRAM_GLOBAL_RATE, 1),    # paced: a burst on top of the rate would break the 1s window
+})
+
+# ------------- Outbound Telegram queue: flood limits, retry_after, coalescing -------------
+class _Outgoing:
+    __slots__ = ("kind", "message", "text", "parse_mode", "coalesce", "factory", "future")
+
+    def __init__(self, kind, message=None, text=None, parse_mode=None, coalesce=False, factory=None):
+        self.kind = kind                # "reply" | "edit" | "call"
+        self.message = message
+        self.text = text
+        self.parse_mode = parse_mode
+        self.coalesce = coalesce
+        self.factory = factory
+        self.future = asyncio.get_running_loop().create_future()
+        self.future.add_done_callback(_retrieve_exception)
+
+def _retrieve_exception(fut):
+    # fire-and-forget sends: failures are logged by the outbox, not re-raised at GC
+    if not fut.cancelled():
+        fut.exception()
+
+class Outbox:
+    """Every Bot API send/edit from the handlers goes through here.
+
+    Each chat has a FIFO drained by one task (started on demand, like
+    UpdateDispatcher), so replies keep their order. Before every call the
+    chat's token bucket (private chats and groups have different limits)
+    must have a token, and every new message also needs one from the paced
+    global bucket; edits only count against their chat, as on Telegram, so
+    streaming answers do not hold up other users' first replies. Chats wait
+    for the global bucket in one FIFO. A RetryAfter pauses that chat for
+    `retry_after` seconds, then the same call is retried.
+    Queued short replies to one chat go out as one message, and a queued edit
+    of a message is overwritten by a newer edit, so a status message only
+    shows its latest text. Methods return a future for the sent Message:
+    await it when you need the message (or delivery), skip it when you don't.
+    """
+
+    def __init__(self, coalesce_chars: int, max_retries: int):
+        self.coalesce_chars = coalesce_chars
+        self.max_retries = max_retries
+        self._chats = {}            # chat id -> deque of _Outgoing
+        self._tasks = set()
+        self._paused = {}           # chat id -> monotonic time its RetryAfter ends
+        self._gate = deque()        # futures of chats waiting for the global bucket, FIFO
+        self._pacer = None
+        self.sent = 0
+        self.coalesced = 0
+        self.edits_replaced = 0
+        self.flood_waits = 0
+        self.failed = 0
+
+    def stats(self):
+        return {"chats": len(self._chats), "queued": sum(len(q) for q in self._chats.values()), "sent": self.sent,
+                "coalesced": self.coalesced, "edits_replaced": self.edits_replaced,
+                "flood_waits": self.flood_waits, "failed": self.failed}
+
+    def reply(self, message, text: str, parse_mode: str | None = None, coalesce: bool = True):
+        """Reply in message's chat. coalesce=False for messages that get edited later."""
+        item = _Outgoing("reply", message, text, parse_mode, coalesce and len(text) <= self.coalesce_chars)
+        return self._enqueue(message.chat_id, item)
+
+    def edit(self, message, text: str, parse_mode: str | None = None):
+        for queued in self._chats.get(message.chat_id, ()):
+            if queued.kind == "edit" and queued.message.message_id == message.message_id:
+                queued.text, queued.parse_mode = text, parse_mode
+                self.edits_replaced += 1
+                return queued.future
+        return self._enqueue(message.chat_id, _Outgoing("edit", message, text, parse_mode))
+
+    def call(self, chat_id: int, factory):
+        """Any other Bot API call; factory() builds a fresh coroutine per attempt."""
+        return self._enqueue(chat_id, _Outgoing("call", factory=factory))
+
+    def _enqueue(self, chat_id, item):
+        chat_queue = self._chats.get(chat_id)
+        if chat_queue is None:
+            chat_queue = self._chats[chat_id] = deque([item])
+            task = asyncio.get_running_loop().create_task(self._drain(chat_id, chat_queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            chat_queue.append(item)
+        return item.future
+
+    def _take(self, chat_queue):
+        """Next item plus any short replies right behind it that fit in one message."""
+        head = chat_queue.popleft()
+        batch = [head]
+        if head.kind == "reply" and head.coalesce:
+            size = len(head.text)
+            while (chat_queue and chat_queue[0].kind == "reply" and chat_queue[0].coalesce
+                   and chat_queue[0].parse_mode == head.parse_mode
+                   and size + 2 + len(chat_queue[0].text) <= TELEGRAM_MAX_MESSAGE):
+                size += 2 + len(chat_queue[0].text)
+                batch.append(chat_queue.popleft())
+            self.coalesced += len(batch) - 1
+        return batch
+
+    @staticmethod
+    def _send(batch):
+        head = batch[0]
+        if head.kind == "reply":
+            return head.message.reply_text("\n\n".join(i.text for i in batch), parse_mode=head.parse_mode)
+        if head.kind == "edit":
+            return head.message.edit_text(head.text, parse_mode=head.parse_mode)
+        return head.factory()
+
+    async def _wait_turn(self, chat_id, kind):
+        until = self._paused.pop(chat_id, 0.0)
+        if until > time.monotonic():
+            await asyncio.sleep(until - time.monotonic())
+        await rate_limiter.acquire("tg_group" if chat_id < 0 else "tg_chat", chat_id, max_wait=float("inf"))
+        if kind == "edit":
+            return
+        loop = asyncio.get_running_loop()
+        turn = loop.create_future()
+        self._gate.append(turn)
+        if self._pacer is None or self._pacer.done():
+            self._pacer = loop.create_task(self._pace())
+        await turn
+
+    async def _pace(self):
+        """Hand out tg_global tokens to the gate queue in order."""
+        while self._gate:
+            wait = await rate_limiter.try_acquire("tg_global")
+            if wait:
+                await asyncio.sleep(wait)
+                continue
+            while self._gate:
+                turn = self._gate.popleft()
+                if not turn.done():   # skip waiters cancelled meanwhile
+                    turn.set_result(None)
+                    break
+
+    async def _deliver(self, chat_id, batch):
+        from telegram.error import BadRequest, RetryAfter
+        for attempt in range(self.max_retries + 1):
+            await self._wait_turn(chat_id, batch[0].kind)
+            try:
+                return await self._send(batch)
+            except RetryAfter as e:
+                self.flood_waits += 1
+                if attempt == self.max_retries:
+                    raise
+                wait = e.retry_after
+                wait = wait.total_seconds() if hasattr(wait, "total_seconds") else float(wait)
+                logger.warning("Telegram flood control in chat %s: waiting %.0fs", chat_id, wait)
+                self._paused[chat_id] = time.monotonic() + wait
+            except BadRequest as e:
+                if batch[0].kind == "edit" and "not modified" in str(e).lower():
+                    return None
+                raise
+
+    async def _drain(self, chat_id, chat_queue):
+        try:
+            while chat_queue:
+                batch = self._take(chat_queue)
+                try:
+                    result = await self._deliver(chat_id, batch)
+                    self.sent += 1
+                except Exception as e:
+                    self.failed += 1
+                    logger.warning("Telegram %s to chat %s failed: %s", batch[0].kind, chat_id, e)
+                    for item in batch:
+                        if not item.future.done():
+                            item.future.set_exception(e)
+                    continue
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_result(result)
+        finally:
+            if self._chats.get(chat_id) is chat_queue:
+                del self._chats[chat_id]
+
+    async def drain(self):
+        """Wait until everything queued so far has been sent (shutdown)."""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+outbox = Outbox(OUTBOX_COALESCE_CHARS, OUTBOX_MAX_RETRIES)
+
+# ------------- Image job scheduler -------------
+class ImageJobError(Exception):
+    """An image job that was not run: reason is "full", "expired" or "cancelled"."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+class _ImageJob:
+    __slots__ = ("user_id", "factory", "future", "deadline", "on_position", "position", "task", "trace_id")
+
+    def __init__(self, user_id, factory, deadline, on_position):
+        self.trace_id = trace_id_var.get()
+        self.user_id = user_id
+        self.factory = factory
+        self.future = asyncio.get_running_loop().create_future()
+        self.deadline = deadline
+        self.on_position = on_position
+        self.position = None
+        self.task = None
+
+class ImageScheduler:
+    """Bounded worker pool between /image and Vertex.
+
+    Jobs are ordered by (priority class, user's jobs already in flight, images
+    the user already made today, arrival), so admins go first, nobody's second
+    job overtakes someone else's first, and lighter users are served before
+    heavy ones. Jobs that waited longer than max_wait are dropped, and every
+    queued job is told its live position.
+    """
+
+    def __init__(self, workers: int, max_queued: int, max_wait: float):
+        self.workers = max(1, workers)
+        self.max_queued = max_queued
+        self.max_wait = max_wait
+        self._heap = []
+        self._seq = itertools.count()
+        self._available = None
+        self._tasks = []
+        self._running = set()
+        self._per_user = {}
+        self._callbacks = set()
+        self.completed = 0
+        self.expired = 0
+        self.cancelled = 0
+        self.rejected = 0
+
+    def _ensure_workers(self):
+        if not self._tasks:
+            self._available = asyncio.Semaphore(0)
+            loop = asyncio.get_running_loop()
+            self._tasks = [loop.create_task(self._worker()) for _ in range(self.workers)]
+
+    def _tell(self, job, position):
+        if job.position == position or job.on_position is None:
+            return
+        job.position = position
+        task = asyncio.get_running_loop().create_task(job.on_position(position))
+        self._callbacks.add(task)
+        task.add_done_callback(self._callbacks.discard)
+
+    def _publish_positions(self):
+        pos = 1
+        for _, job in sorted(self._heap):
+            if not job.future.done():
+                self._tell(job, pos)
+                pos += 1
+
+    @property
+    def queued(self):
+        return sum(1 for _, job in self._heap if not job.future.done())
+
+    async def run(self, user_id: str, factory, priority: int = 1, used: int = 0, on_position=None):
+        """Queue `factory()` and return its result once a worker has run it.
+        on_position(n) is awaited with the queue position (0 = now running)."""
+        self._ensure_workers()
+        if self.queued >= self.max_queued:
+            self.rejected += 1
+            raise ImageJobError("full")
+        job = _ImageJob(user_id, factory, time.monotonic() + self.max_wait, on_position)
+        rank = self._per_user.get(user_id, 0)
+        self._per_user[user_id] = rank + 1
+        heapq.heappush(self._heap, ((priority, rank, used, next(self._seq)), job))
+        self._available.release()
+        self._publish_positions()
+        try:
+            return await job.future
+        finally:
+            if job.task is not None and not job.task.done():
+                job.task.cancel()
+            left = self._per_user.get(user_id, 1) - 1
+            if left > 0:
+                self._per_user[user_id] = left
+            else:
+                self._per_user.pop(user_id, None)
+
+    def cancel(self, user_id: str):
+        """Cancel every queued or running job of a user; returns how many."""
+        n = 0
+        for job in [job for _, job in self._heap] + list(self._running):
+            if job.user_id == user_id and not job.future.done():
+                job.future.set_exception(ImageJobError("cancelled"))
+                if job.task is not None:
+                    job.task.cancel()
+                n += 1
+        self.cancelled += n
+        if n:
+            self._publish_positions()
+        return n
+
+    async def _worker(self):
+        while True:
+            await self._available.acquire()
+            _, job = heapq.heappop(self._heap)
+            self._publish_positions()
+            if job.future.done():
+                continue
+            if time.monotonic() > job.deadline:
+                self.expired += 1
+                job.future.set_exception(ImageJobError("expired"))
+                continue
+            self._tell(job, 0)
+            trace_id_var.set(job.trace_id)   # copied into the job task's context
+            job.task = asyncio.get_running_loop().create_task(job.factory())
+            self._running.add(job)
+            try:
+                await asyncio.wait({job.task})
+            finally:
+                self._running.discard(job)
+            if job.future.done():
+                # cancelled/expired while the factory finished: free what it produced
+                if not job.task.cancelled() and job.task.exception() is None:
+                    close = getattr(job.task.result(), "close", None)
+                    if close:
+                        close()
+                continue
+            if job.task.cancelled():
+                job.future.set_exception(ImageJobError("cancelled"))
+            elif job.task.exception() is not None:
+                job.future.set_exception(job.task.exception())
+            else:
+                self.completed += 1
+                job.future.set_result(job.task.result())
+
+    def stats(self):
+        return {"queued": self.queued, "running": len(self._running), "completed": self.completed,
+                "expired": self.expired, "cancelled": self.cancelled, "rejected": self.rejected}
+
+image_scheduler = ImageScheduler(IMAGE_WORKERS, IMAGE_QUEUE_MAX, IMAGE_JOB_MAX_WAIT)
+
+# ------------- Response cache (/ask, /search) -------------
+def normalize_query(query: str):
+    """Case/whitespace/trailing-punctuation insensitive cache key."""
+    return re.sub(r"\s+", " ", query).strip().rstrip("?!.").strip().lower()
+
+class ResponseCache:
+    """Two-tier cache for upstream answers: an in-memory LRU capped in bytes,
+    backed by an optional SQLite file. Concurrent misses for the same key share
+    one upstream call (single-flight). Values must be JSON-serializable.
+
+    The SQLite tier runs on one dedicated thread (reads are awaited, writes
+    are fire-and-forget) and tracks its size as a running total, recounted
+    every DB_RECOUNT writes and before evicting, since shard workers may
+    share the file."""
+
+    DB_RECOUNT = 256
+
+    def __init__(self, max_bytes: int, db_path: str | None = None, db_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.db_max_bytes = db_max_bytes
+        self._mem = OrderedDict()   # key -> (value, expires_at, size)
+        self._bytes = 0
+        self._inflight = {}
+        self._db = None
+        self._db_bytes = 0
+        self._db_writes = 0
+        self._executor = None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.joined = 0
+        if db_path:
+            try:
+                self._db = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None,
+                                           timeout=SQLITE_BUSY_TIMEOUT)
+                self._db.execute("PRAGMA journal_mode=WAL")
+                self._db.execute(
+                    "CREATE TABLE IF NOT EXISTS responses ("
+                    "key TEXT PRIMARY KEY, value TEXT, expires_at REAL, size INTEGER, used_at REAL)"
+                )
+                self._db.execute("CREATE INDEX IF NOT EXISTS responses_expires ON responses (expires_at)")
+                self._db.execute("CREATE INDEX IF NOT EXISTS responses_used ON responses (used_at)")
+                self._db_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache")
+            except sqlite3.Error as e:
+                logger.warning("Response cache DB disabled: %s", e)
+                self._db = None
+
+    @staticmethod
+    def _key(backend: str, query: str):
+        return f"{backend}:{normalize_query(query)}"
+
+    def _mem_put(self, key, value, expires_at, size):
+        if size > self.max_bytes:
+            return
+        old = self._mem.pop(key, None)
+        if old is not None:
+            self._bytes -= old[2]
+        self._mem[key] = (value, expires_at, size)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            _, (_, _, evicted) = self._mem.popitem(last=False)
+            self._bytes -= evicted
+
+    def _disk_get(self, key):
+        """Blocking (cache thread): (value, seconds left, size) or None."""
+        try:
+            row = self._db.execute("SELECT value, expires_at, size FROM responses WHERE key = ?", (key,)).fetchone()
+            wall = time.time()
+            if row is None or row[1] <= wall:
+                return None
+            self._db.execute("UPDATE responses SET used_at = ? WHERE key = ?", (wall, key))
+            return json.loads(row[0]), row[1] - wall, row[2]
+        except (sqlite3.Error, ValueError) as e:
+            logger.warning("Response cache DB read failed: %s", e)
+            return None
+
+    def _disk_put(self, key, encoded, ttl, size):
+        """Blocking (cache thread)."""
+        try:
+            wall = time.time()
+            old = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT INTO responses (key, value, expires_at, size, used_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at, "
+                "size = excluded.size, used_at = excluded.used_at",
+                (key, encoded, wall + ttl, size, wall),
+            )
+            self._db_bytes += size - (old[0] if old else 0)
+            self._db_writes += 1
+            if self._db_writes % self.DB_RECOUNT == 0 or self._db_bytes > self.db_max_bytes:
+                self._db.execute("DELETE FROM responses WHERE expires_at <= ?", (wall,))
+                self._db_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if self._db_bytes > self.db_max_bytes:
+                # evict least recently used rows until under the cap
+                excess = self._db_bytes - self.db_max_bytes
+                victims, freed = [], 0
+                for k, sz in self._db.execute("SELECT key, size FROM responses ORDER BY used_at"):
+                    victims.append((k,))
+                    freed += sz
+                    if freed >= excess:
+                        break
+                self._db.executemany("DELETE FROM responses WHERE key = ?", victims)
+                self._db_bytes -= freed
+        except sqlite3.Error as e:
+            logger.warning("Response cache DB write failed: %s", e)
+
+    async def get(self, backend: str, query: str):
+        """Return (value,) on a hit, None on a miss."""
+        key = self._key(backend, query)
+        now = time.monotonic()
+        entry = self._mem.get(key)
+        if entry is not None:
+            if entry[1] > now:
+                self._mem.move_to_end(key)
+                self.hits += 1
+                return (entry[0],)
+            self._bytes -= entry[2]
+            del self._mem[key]
+        if self._db is not None:
+            found = await asyncio.get_running_loop().run_in_executor(self._executor, self._disk_get, key)
+            if found is not None:
+                value, left, size = found
+                # promote to memory with the remaining lifetime
+                self._mem_put(key, value, time.monotonic() + left, size)
+                self.disk_hits += 1
+                return (value,)
+        return None
+
+    def put(self, backend: str, query: str, value, ttl: float):
+        key = self._key(backend, query)
+        encoded = json.dumps(value)
+        size = len(encoded.encode())
+        self._mem_put(key, value, time.monotonic() + ttl, size)
+        if self._db is not None:
+            self._executor.submit(self._disk_put, key, encoded, ttl, size)
+
+    async def get_or_fetch(self, backend: str, query: str, ttl: float, fetch):
+        """Cached value, or the result of `await fetch()` shared by every concurrent caller.
+        None results are returned but not cached."""
+        found = await self.get(backend, query)
+        if found is not None:
+            return found[0]
+        key = self._key(backend, query)
+        fut = self._inflight.get(key)
+        if fut is not None:
+            self.joined += 1
+            return await asyncio.shield(fut)
+        self.misses += 1
+        fut = asyncio.get_running_loop().create_future()
+        self._inflight[key] = fut
+        try:
+            value = await fetch()
+        except asyncio.CancelledError:
+            fut.cancel()
+            raise
+        except Exception as e:
+            fut.set_exception(e)
+            fut.exception()   # mark retrieved when nobody joined
+            raise
+        else:
+            fut.set_result(value)
+            if value is not None:
+                self.put(backend, query, value, ttl)
+            return value
+        finally:
+            self._inflight.pop(key, None)
+
+    def stats(self):
+        return {"hits": self.hits, "disk_hits": self.disk_hits, "misses": self.misses,
+                "joined": self.joined, "entries": len(self._mem), "bytes": self._bytes}
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_DB, RESPONSE_CACHE_DB_MAX_BYTES)
+
+# ------------- Long / streamed replies -------------
+def split_message(text: str, limit: int = TELEGRAM_MAX_MESSAGE):
+    """Split text into Telegram-sized pieces, preferring newline boundaries."""
+    parts = []
+    while len(text) > limit:
+        cut = text.rfind("\n", limit // 2, limit)
+        if cut == -1:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip("\n")
+    if text or not parts:
+        parts.append(text)
+    return parts
+
+class StreamingReply:
+    """Renders a growing answer into a placeholder message by editing it in
+    place, at most once per `min_interval` seconds, and continues in follow-up
+    messages once the text passes Telegram's length limit."""
+
+    def __init__(self, message, min_interval: float = STREAM_EDIT_INTERVAL):
+        self.min_interval = min_interval
+        self.text = ""
+        self._messages = [message]
+        self._shown = [message.text or ""]
+        self._last_render = 0.0
+
+    async def feed(self, chunk: str):
+        self.text += chunk
+        if time.monotonic() - self._last_render >= self.min_interval:
+            await self._render(final=False)
+
+    async def finish(self, text: str | None = None):
+        if text is not None:
+            self.text = text
+        await self._render(final=True)
+
+    async def _render(self, final: bool):
+        # intermediate edits are not awaited: while flood control holds the
+        # outbox, newer frames overwrite the queued edit instead of piling up
+        self._last_render = time.monotonic()
+        edits = []
+        for i, part in enumerate(split_message(self.text)):
+            if not part.strip():
+                continue
+            if i < len(self._messages):
+                if self._shown[i] != part:
+                    edits.append(outbox.edit(self._messages[i], part))
+                    self._shown[i] = part
+            else:
+                self._messages.append(await outbox.reply(self._messages[-1], part, coalesce=False))
+                self._shown.append(part)
+        if final and edits:
+            await asyncio.gather(*edits)
+
+# ------------- Gemini / Google search calls -------------
+GEMINI_URL = f"{GEMINI_BASE_URL}/gemini-pro"
+
+async def gemini_available():
+    # open breaker -> straight to the echo fallback, no rate budget spent
+    return (bool(GEMINI_API_KEY) and resilience.available("gemini")
+            and await rate_limiter.acquire("gemini", max_wait=10))
+
+async def gemini_answer(query: str):
+    """Answer text from Gemini, or None when Gemini is unavailable."""
+    if not await gemini_available():
+        return None
+    url = f"{GEMINI_URL}:generateContent?key={GEMINI_API_KEY}"
+    payload = {"contents": [{"parts": [{"text": query}]}]}
+    headers = {"Content-Type": "application/json"}
+    resp = await resilience.request("gemini", "POST", url, json=payload, headers=headers)
+    resp.raise_for_status()
+    data = resp.json()
+    return data["candidates"][0]["content"]["parts"][0]["text"]
+
+async def gemini_stream_answer(query: str, reply: StreamingReply):
+    """Stream a Gemini answer (SSE) into `reply` and return the full text,
+    or None when Gemini is unavailable."""
+    if not await gemini_available():
+        return None
+    url = f"{GEMINI_URL}:streamGenerateContent?alt=sse&key={GEMINI_API_KEY}"
+    payload = {"contents": [{"parts": [{"text": query}]}]}
+    headers = {"Content-Type": "application/json"}
+    async with resilience.stream("gemini", "POST", url, json=payload, headers=headers) as resp:
+        resp.raise_for_status()
+        async for line in resp.aiter_lines():
+            if not line.startswith("data:"):
+                continue
+            data = json.loads(line[5:])
+            for cand in (data.get("candidates") or [])[:1]:
+                for part in (cand.get("content") or {}).get("parts") or []:
+                    if part.get("text"):
+                        await reply.feed(part["text"])
+    return reply.text or None
+
+async def google_search(query: str):
+    """Top 3 Custom Search results as {title, link, snippet} dicts."""
+    params = {"key": GOOGLE_API_KEY, "cx": SEARCH_ENGINE_ID, "q": query, "num": 3}
+    resp = await resilience.request("search", "GET", SEARCH_API_URL, params=params)
+    resp.raise_for_status()
+    data = resp.json()
+    return [
+        {"title": it.get("title", "No Title"), "link": it.get("link", "#"),
+         "snippet": (it.get("snippet") or "").replace("\n", " ")}
+        for it in data.get("items", [])[:3]
+    ]
 
 # ------------- Telegram command handlers -------------
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        await update.message.reply_text("TEST OK! Bot is alive!")
+        await outbox.reply(update.message, "TEST OK! Bot is alive!")
         logger.info("Successfully sent test reply!")
     except Exception as e:
         logger.exception("ERROR SENDING REPLY: %s", e)
 
 async def ask_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
-        await update.message.reply_text("❓ Example: /ask What is GPT?")
+        await outbox.reply(update.message, "❓ Example: /ask What is GPT?")
         return
     query = " ".join(context.args)
-    await update.message.reply_text("🧠 Thinking... (Gemini)")
-    if GEMINI_API_KEY:
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-pro:generateContent?key={GEMINI_API_KEY}"
-        payload = {"contents": [{"parts": [{"text": query}]}]}
-        headers = {"Content-Type": "application/json"}
-        try:
-            resp = await _async_post(url, json=payload, headers=headers)
-            resp.raise_for_status()
-            data = resp.json()
-            ans = data["candidates"][0]["content"]["parts"][0]["text"]
-            await update.message.reply_text(ans)
+    if await rate_limiter.try_acquire("ask", str(update.effective_user.id)):
+        await outbox.reply(update.message, "⏳ Itne saare sawal ek saath? Thoda ruk ke poocho 😅")
+        return
+    found = await response_cache.get("ask", query)
+    if found is not None:
+        for part in split_message(found[0]):
+            await outbox.reply(update.message, part)
+        return
+    thinking = await outbox.reply(update.message, "🧠 Thinking... (Gemini)", coalesce=False)
+    reply = StreamingReply(thinking)
+    if ASK_STREAM:
+        fetch = lambda: gemini_stream_answer(query, reply)
+    else:
+        fetch = lambda: gemini_answer(query)
+    try:
+        ans = await response_cache.get_or_fetch("ask", query, ASK_CACHE_TTL, fetch)
+        if ans:
+            await reply.finish(ans)
+            return
+    except UpstreamUnavailable as e:
+        logger.warning("Gemini unavailable: %s", e)
+    except Exception as e:
+        logger.exception("Gemini failed: %s", e)
+        if reply.text:
+            await reply.finish(reply.text + "\n\n⚠️ (jawab beech me hi ruk gaya)")
             return
-        except Exception as e:
-            logger.exception("Gemini failed: %s", e)
     # fallback echo
-    await update.message.reply_text(f"💬 (fallback) You asked: {query}")
+    await outbox.reply(update.message, f"💬 (fallback) You asked: {query}")
 
 async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not context.args:
-        await update.message.reply_text("❓ Example: /search (5*4)/2 or /search Taj Mahal")
+        await outbox.reply(update.message, "❓ Example: /search (5*4)/2 or /search Taj Mahal")
         return
     query = " ".join(context.args)
-    m = safe_math(query)
+    if await rate_limiter.try_acquire("search", str(update.effective_user.id)):
+        await outbox.reply(update.message, "⏳ Search thoda dheere karo boss, ek minute me fir try karo.")
+        return
+    m = await safe_math(query)
     if m is not None:
-        await update.message.reply_html(f"🧮 <b>{query} = {m}</b>")
+        await outbox.reply(update.message, m, parse_mode="HTML")
         return
     if GOOGLE_API_KEY and SEARCH_ENGINE_ID:
-        await update.message.reply_text(f"🔎 Searching Google for: {query}")
-        api_url = "https://www.googleapis.com/customsearch/v1"
-        params = {"key": GOOGLE_API_KEY, "cx": SEARCH_ENGINE_ID, "q": query, "num": 3}
+        status = None
         try:
-            resp = await _async_get(api_url, params=params)
-            resp.raise_for_status()
-            data = resp.json()
-            items = data.get("items", [])[:3]
-            if not items:
-                await update.message.reply_text("Kuch khaas nahi mila.")
-                return
-            for it in items:
-                title = it.get("title", "No Title")
-                link = it.get("link", "#")
-                snippet = (it.get("snippet") or "").replace("\n", " ")
-                await update.message.reply_html(f"▶️ <b>{title}</b>\n📝 <i>{snippet}</i>\n<a href='{link}'>Read more</a>")
+            found = await response_cache.get("search", query)
+            if found is not None:
+                items = found[0]
+            else:
+                # not awaited: the fetch starts right away, the results then edit this message
+                status = outbox.reply(update.message, f"🔎 Searching Google for: {query}", coalesce=False)
+                items = await response_cache.get_or_fetch("search", query, SEARCH_CACHE_TTL, lambda: google_search(query))
+            results = [f"▶️ <b>{html.escape(it['title'])}</b>\n📝 <i>{html.escape(it['snippet'])}</i>\n"
+                       f"<a href='{html.escape(it['link'])}'>Read more</a>"
+                       for it in items] or ["Kuch khaas nahi mila."]
+            if status is not None:
+                await outbox.edit(await status, "\n\n".join(results), parse_mode="HTML")
+            else:
+                # queued together, so the outbox sends them as one message
+                await asyncio.gather(*[outbox.reply(update.message, r, parse_mode="HTML") for r in results])
             return
+        except UpstreamUnavailable as e:
+            logger.warning("Google search unavailable: %s", e)
         except Exception as e:
             logger.exception("Google search failed: %s", e)
-            await update.message.reply_text("Google search me problem aa rahi hai.")
-            return
-    await update.message.reply_text("Google keys missing and not a math expression.")
+        if status is not None:
+            with contextlib.suppress(Exception):
+                await outbox.edit(await status, "Google search me problem aa rahi hai.")
+                return
+        await outbox.reply(update.message, "Google search me problem aa rahi hai.")
+        return
+    await outbox.reply(update.message, "Google keys missing and not a math expression.")
 
 async def quota_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
-    usage = await get_usage(user_id)
-    limit = await get_daily_limit(user_id)
-    await update.message.reply_text(f"📦 Aaj tumne {usage['count']}/{limit} images use kiye hain. Baaki: {max(0, limit-usage['count'])}")
+    snap = await get_quota_snapshot(user_id)
+    limit = snap["limit"]
+    await outbox.reply(update.message, f"📦 Aaj tumne {snap['count']}/{limit} images use kiye hain. Baaki: {max(0, limit-snap['count'])}")
 
 async def image_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     user_id = str(user.id)
 
-    prompt_text, size_flag, seed_flag, negative_flag = parse_image_args(context.args)
+    parsed = parse_image_args(context.args)
+    prompt_text, size_flag, seed_flag, negative_flag, count = parsed
     if not prompt_text:
-        await update.message.reply_text("🖼 Example: /image a beautiful landscape --size 1024 --seed 42 --no watermark")
+        await outbox.reply(update.message, "🖼 Example: /image a beautiful landscape --size 1024 --seed 42 --n 2 --no watermark")
         return
 
-    # cooldown (friendly)
-    ok = await check_and_update_cooldown(user_id)
-    if not ok:
-        await update.message.reply_text(f"⏳ Chill karo yaar! 5 second ka traffic signal hai, fir dobara try karo 😜")
+    # cooldown (local token bucket, no network)
+    wait = await rate_limiter.try_acquire("image", user_id)
+    if wait:
+        await outbox.reply(update.message, f"⏳ Chill karo yaar! {int(wait) + 1} second ka traffic signal hai, fir dobara try karo 😜")
         return
 
-    usage = await get_usage(user_id)
-    daily_limit = await get_daily_limit(user_id)
-    if usage["count"] >= daily_limit:
-        await update.message.reply_text("🚫 Arre boss! Aaj ka daily image limit khatam ho gaya. Kal fir try karo 😅")
+    # one read for daily limit and monthly cap
+    now = time.time()
+    snap = await get_quota_snapshot(user_id)
+
+    if snap["count"] >= snap["limit"]:
+        await outbox.reply(update.message, "🚫 Arre boss! Aaj ka daily image limit khatam ho gaya. Kal fir try karo 😅")
         return
 
-    monthly_total = await get_monthly_total()
+    caption = f"{prompt_text}  (size={size_flag or '1024'}, seed={seed_flag or 'auto'})"
+    if count > 1:
+        caption += f" ×{count}"
+
+    # seeded repeat: resend the earlier upload (or cached bytes), no Vertex call, no monthly quota
+    cache_keys = image_cache.keys(parsed)
+    if cache_keys and snap["count"] + count <= snap["limit"]:
+        file_ids = image_cache.get_file_ids(cache_keys)
+        if file_ids:
+            try:
+                await _reply_photos(update, file_ids, caption)
+                image_cache.hits += 1
+                await commit_image_usage(user_id, count, now, monthly=False)
+                return
+            except Exception as e:
+                logger.warning("Cached file_id failed, regenerating: %s", e)
+                for key in cache_keys:
+                    image_cache.drop_file_id(key)
+        cached_files = image_cache.open_files(cache_keys)
+        if cached_files:
+            image_cache.byte_hits += 1
+            batch = ImageBatch(cached_files)
+            try:
+                await _send_images(update, cache_keys, batch, caption)
+            finally:
+                batch.close()
+            await commit_image_usage(user_id, count, now, monthly=False)
+            return
+        image_cache.misses += 1
+
+    monthly_total = snap["monthly_total"]
+    # --n asks for more than what's left today / this month -> generate what fits
+    count = min(count, snap["limit"] - snap["count"], max(1, DEFAULT_MONTHLY_CAP - monthly_total))
     if monthly_total >= DEFAULT_MONTHLY_CAP:
-        await update.message.reply_text("🚫 Arre boss! Is mahine ka global image quota full ho gaya 😅 Next month fresh supply milegi.")
+        await outbox.reply(update.message, "🚫 Arre boss! Is mahine ka global image quota full ho gaya 😅 Next month fresh supply milegi.")
         return
-    elif monthly_total >= 0.8 * DEFAULT_MONTHLY_CAP:
-        await update.message.reply_text("⚠️ Heads-up: Global monthly quota 80% cross ho chuki hai. Jaldi use mat maar do!")
+    heads_up = ""
+    if monthly_total >= 0.8 * DEFAULT_MONTHLY_CAP:
+        heads_up = "⚠️ Heads-up: Global monthly quota 80% cross ho chuki hai. Jaldi use mat maar do!\n"
+
+    # reserve the images up front; last_ts reaches Firebase with the next background flush
+    await commit_image_usage(user_id, count, now)
+
+    # one status message for the whole job: queue position, progress and failures are edits of it
+    note = f" (quota me sirf {count} bachi thi)" if count < parsed[4] else ""
+    try:
+        status = await outbox.reply(update.message, f"{heads_up}🎨 Artist kaam shuru kar raha hai... thoda sa intezar karo 😉{note}",
+                                    coalesce=False)
+    except Exception:
+        await commit_image_usage(user_id, -count)   # chat blocked / flood retries used up: nothing was generated
+        raise
 
-    await update.message.reply_text("🎨 Artist kaam shuru kar raha hai... thoda sa intezar karo 😉")
+    async def show_position(pos):
+        text = ("🎨 Ab tumhari image ban rahi hai... 😉" if pos == 0
+                else f"⏳ Line me ho — tumse aage {pos - 1} log hain. /cancel se cancel kar sakte ho.")
+        outbox.edit(status, heads_up + text)
 
-    img_bytes = await vertex_generate_image(prompt_text, size=size_flag, seed=seed_flag, negative=negative_flag)
-    if not img_bytes:
-        await update.message.reply_text("💥 Image banane me problem aayi. Ho sakta hai prompt safe na ho ya API busy ho.")
+    images, failure = None, "💥 Image banane me problem aayi. Ho sakta hai prompt safe na ho ya API busy ho."
+    try:
+        images = await image_scheduler.run(
+            user_id,
+            lambda: vertex_generate_image(prompt_text, size=size_flag, seed=seed_flag, negative=negative_flag, n=count),
+            priority=0 if is_admin(user_id) else 1,
+            used=snap["count"],
+            on_position=show_position,
+        )
+    except ImageJobError as e:
+        failure = {
+            "full": "🚦 Abhi bahut rush hai, queue full hai. Thodi der baad try karo 🙏",
+            "expired": "⌛ Queue me bahut der ho gayi, job drop kar diya. Fir se try karo.",
+            "cancelled": "🛑 Image job cancel ho gaya.",
+        }[e.reason]
+    except Exception as e:
+        logger.exception("Image job failed: %s", e)
+    if not images:
+        # give the reserved images back, keep the cooldown stamp
+        await commit_image_usage(user_id, -count)
+        try:
+            await outbox.edit(status, failure)
+        except Exception:
+            await outbox.reply(update.message, failure)
         return
+    if len(images) < count:
+        # quota counts images produced, not images asked for
+        await commit_image_usage(user_id, len(images) - count)
+
+    try:
+        # partial batches are not cached: the keys describe all `count` samples
+        cache_keys = cache_keys if cache_keys and len(images) == len(cache_keys) else None
+        if cache_keys:
+            for key, f in zip(cache_keys, images.files):
+                image_cache.put_file(key, f)
+        await _send_images(update, cache_keys, images, caption)
+    finally:
+        images.close()
+
+async def _reply_photos(update: Update, photos: list, caption: str):
+    """One image -> reply_photo/reply_document; several -> a single media group
+    (caption on the first). IMAGE_DELIVERY=document sends full-quality files.
+    `photos` are file_ids or (file, filename) pairs; files are rewound and
+    re-wrapped on every attempt, so a RetryAfter retry uploads them again.
+    Returns the sent messages."""
+    from telegram import InputFile, InputMediaDocument, InputMediaPhoto
+    document = IMAGE_DELIVERY == "document"
+    message = update.message
 
+    def media_input(photo):
+        if isinstance(photo, str):
+            return photo
+        f, name = photo
+        f.seek(0)
+        return InputFile(f, filename=name, read_file_handle=False)
+
+    async def send():
+        inputs = [media_input(p) for p in photos]
+        if len(inputs) == 1:
+            if document:
+                return [await message.reply_document(document=inputs[0], caption=caption)]
+            return [await message.reply_photo(photo=inputs[0], caption=caption)]
+        media_type = InputMediaDocument if document else InputMediaPhoto
+        media = [media_type(m, caption=caption if i == 0 else None) for i, m in enumerate(inputs)]
+        return list(await message.reply_media_group(media=media))
+
+    return await outbox.call(message.chat_id, send)
+
+def _sent_file_id(msg):
+    if msg.document:
+        return msg.document.file_id
+    return msg.photo[-1].file_id if msg.photo else None
+
+async def _send_images(update: Update, cache_keys, batch: ImageBatch, caption: str):
+    """Upload the batch's images and remember their file_ids for seeded repeats.
+    Files are streamed from their spool/cache file, not copied into memory."""
     try:
-        bio = io.BytesIO(img_bytes)
-        bio.name = "ai_image.png"
-        bio.seek(0)
-        caption = f"{prompt_text}  (size={size_flag or '1024'}, seed={seed_flag or 'auto'})"
-        await update.message.reply_photo(photo=InputFile(bio), caption=caption)
+        uploads = await prepare_uploads(batch.files)
+        messages = await _reply_photos(update, uploads, caption)
+        if cache_keys:
+            for key, msg in zip(cache_keys, messages):
+                file_id = _sent_file_id(msg)
+                if file_id:
+                    image_cache.put_file_id(key, file_id)
     except Exception as e:
         logger.exception("Sending image failed: %s", e)
-        await update.message.reply_text("Image bhejne me problem aa gayi.")
+        await outbox.reply(update.message, "Image bhejne me problem aa gayi.")
 
-    # increment counters
-    await increment_usage(user_id)
+async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    n = image_scheduler.cancel(str(update.effective_user.id))
+    if n:
+        await outbox.reply(update.message, f"🛑 {n} image job cancel kar diye.")
+    else:
+        await outbox.reply(update.message, "Koi image job line me nahi hai.")
 
 # ------------- Admin commands -------------
 def is_admin(user_id):
@@ -384,120 +3013,681 @@ def is_admin(user_id):
 async def resetquota_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     caller = update.effective_user.id
     if not is_admin(caller):
-        await update.message.reply_text("❌ Tum admin nahi ho.")
+        await outbox.reply(update.message, "❌ Tum admin nahi ho.")
         return
     if not context.args:
-        await update.message.reply_text("Usage: /resetquota <user_id>")
+        await outbox.reply(update.message, "Usage: /resetquota <user_id>")
         return
     uid = context.args[0]
     await reset_user_daily(uid)
-    await update.message.reply_text(f"✅ Reset daily quota for {uid}")
+    await outbox.reply(update.message, f"✅ Reset daily quota for {uid}")
 
 async def setlimit_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     caller = update.effective_user.id
     if not is_admin(caller):
-        await update.message.reply_text("❌ Tum admin nahi ho.")
+        await outbox.reply(update.message, "❌ Tum admin nahi ho.")
         return
     if len(context.args) < 2:
-        await update.message.reply_text("Usage: /setlimit <user_id> <daily_limit>")
+        await outbox.reply(update.message, "Usage: /setlimit <user_id> <daily_limit>")
         return
     uid = context.args[0]
     try:
         n = int(context.args[1])
     except ValueError:
-        await update.message.reply_text("daily_limit must be an integer")
+        await outbox.reply(update.message, "daily_limit must be an integer")
         return
-    if FIREBASE_READY:
-        url = f"{FIREBASE_DB_URL}/limits/{uid}/daily.json"
-        await _async_put(url, json=n)
-    await update.message.reply_text(f"✅ Set daily limit for {uid} to {n}")
+    await set_daily_limit(uid, n)
+    await outbox.reply(update.message, f"✅ Set daily limit for {uid} to {n}")
 
 async def resetmonth_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     caller = update.effective_user.id
     if not is_admin(caller):
-        await update.message.reply_text("❌ Tum admin nahi ho.")
+        await outbox.reply(update.message, "❌ Tum admin nahi ho.")
         return
     await reset_monthly_total()
-    await update.message.reply_text("✅ Monthly global quota reset done.")
+    await outbox.reply(update.message, "✅ Monthly global quota reset done.")
 
 async def checkquota_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     monthly_total = await get_monthly_total()
     cap = int(os.getenv("MONTHLY_GLOBAL_CAP", DEFAULT_MONTHLY_CAP))
-    await update.message.reply_text(f"📅 This month: {monthly_total}/{cap} images used.")
+    await outbox.reply(update.message, f"📅 This month: {monthly_total}/{cap} images used.")
 
 async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     caller = update.effective_user.id
     if not is_admin(caller):
-        await update.message.reply_text("❌ Tum admin nahi ho.")
+        await outbox.reply(update.message, "❌ Tum admin nahi ho.")
+        return
+    today = await get_daily_stats()
+    month_total = await get_monthly_stats()
+    lines = [f"{uid}: {c}" for uid, c in today["users"].items()]
+    out = (f"📊 Today total images: {today['total']} (users: {today['active']}, month: {month_total})\n"
+           + ("\n".join(lines) if lines else "No data"))
+    cs = quota_cache.stats()
+    out += (f"\n\n🗄 Quota cache: hits={cs['hits']} misses={cs['misses']} size={cs['size']} "
+            f"pending={cs['pending']} flush_lag={cs['flush_lag']}s flushes={cs['flushes']} errors={cs['flush_errors']}")
+    rc = response_cache.stats()
+    out += (f"\n💬 Response cache: hits={rc['hits']} disk_hits={rc['disk_hits']} misses={rc['misses']} "
+            f"joined={rc['joined']} entries={rc['entries']} bytes={rc['bytes']}")
+    ic = image_cache.stats()
+    out += (f"\n🖼 Image cache: hits={ic['hits']} byte_hits={ic['byte_hits']} misses={ic['misses']} "
+            f"file_ids={ic['file_ids']} files={ic['files']} bytes={ic['bytes']}")
+    sc = image_scheduler.stats()
+    out += "\n🎨 Image jobs: " + " ".join(f"{k}={v}" for k, v in sc.items())
+    out += "\n📦 Image bytes in flight: " + " ".join(f"{k}={v}" for k, v in image_bytes_budget.stats().items())
+    out += "\n⏱ Rate-limit keys: " + ", ".join(f"{k}={v}" for k, v in rate_limiter.stats().items())
+    out += "\n🛡 Upstreams: " + " ".join(f"{k}={v}" for k, v in resilience.stats().items())
+    if _shard_index is not None:
+        out += f"\n🧩 Shard worker {_shard_index + 1}/{POLL_WORKERS} (pid {os.getpid()})"
+    out += "\n📤 Outbox: " + " ".join(f"{k}={v}" for k, v in outbox.stats().items())
+    out += "\n🧮 Math: " + " ".join(f"{k}={v}" for k, v in math_engine.stats().items())
+    await outbox.reply(update.message, out)
+
+async def compactstats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    caller = update.effective_user.id
+    if not is_admin(caller):
+        await outbox.reply(update.message, "❌ Tum admin nahi ho.")
         return
-    if not FIREBASE_READY:
-        await update.message.reply_text("Firebase not ready.")
+    try:
+        keep_days = int(context.args[0]) if context.args else STATS_KEEP_DAYS
+    except ValueError:
+        await outbox.reply(update.message, "Usage: /compactstats [keep_days]")
         return
-    url = f"{FIREBASE_DB_URL}/usage.json"
-    resp = await _async_get(url)
-    total = 0
-    lines = []
-    if resp.status_code == 200 and resp.json():
-        data = resp.json()
-        today = _today_key()
-        for uid, dates in (data.items() if isinstance(data, dict) else []):
-            c = 0
-            if isinstance(dates, dict) and today in dates and isinstance(dates[today], dict):
-                c = int(dates[today].get("count", 0))
-            if c:
-                total += c
-                lines.append(f"{uid}: {c}")
-    out = f"📊 Today total images: {total}\n" + ("\n".join(lines) if lines else "No data")
-    await update.message.reply_text(out)
-
-# ------------- App & webhook setup -------------
-app = Flask(__name__)
-
-# Build the Telegram application (serverless-safe)
-application = ApplicationBuilder().token(TELEGRAM_TOKEN).build()
-
-# Register handlers
-application.add_handler(CommandHandler("help", help_command))
-application.add_handler(CommandHandler("start", help_command))  # start -> show help
-application.add_handler(CommandHandler("ask", ask_command))
-application.add_handler(CommandHandler("search", search_command))
-application.add_handler(CommandHandler("image", image_command))
-application.add_handler(CommandHandler("quota", quota_command))
-application.add_handler(CommandHandler("resetquota", resetquota_cmd))
-application.add_handler(CommandHandler("setlimit", setlimit_cmd))
-application.add_handler(CommandHandler("resetmonth", resetmonth_cmd))
-application.add_handler(CommandHandler("checkquota", checkquota_cmd))
-application.add_handler(CommandHandler("stats", stats_cmd))
-
-# Set bot commands (menu)
+    await outbox.reply(update.message, "🧹 Usage compaction shuru...")
+    try:
+        res = await compact_usage(keep_days)
+    except Exception as e:
+        logger.exception("Usage compaction failed: %s", e)
+        await outbox.reply(update.message, "Compaction me problem aa gayi.")
+        return
+    await outbox.reply(
+        update.message,
+        f"✅ Stats rebuilt for {res['days']} days ({res['users']} users), archived {res['archived']} old day records."
+    )
+
+# ------------- App & webhook setup (lazy startup) -------------
+# The Telegram Application and the Flask app are built on first access
+# (module attributes `application` / `app` resolve through __getattr__), so a
+# cold start that only answers a health check never imports telegram.ext or
+# flask. LAZY_STARTUP=0 builds both at import time instead.
+_application = None
+_flask_app = None
+_background_tasks = set()
+
+def get_application():
+    global _application
+    if _application is None:
+        from telegram.ext import ApplicationBuilder, CommandHandler
+        from telegram.request import HTTPXRequest
+
+        t0 = time.perf_counter()
+        tls = {"verify": _ssl_context()}
+        application = (
+            ApplicationBuilder()
+            .token(TELEGRAM_TOKEN)
+            .base_url(f"{TELEGRAM_API_BASE}/bot")
+            .base_file_url(f"{TELEGRAM_API_BASE}/file/bot")
+            .request(_instrumented_request_class()(connection_pool_size=TELEGRAM_HTTP_POOL, httpx_kwargs=tls))
+            .get_updates_request(HTTPXRequest(httpx_kwargs=tls))
+            .build()
+        )
+
+        # Register handlers
+        application.add_handler(CommandHandler("help", instrumented("help", help_command)))
+        application.add_handler(CommandHandler("start", instrumented("start", help_command)))  # start -> show help
+        application.add_handler(CommandHandler("ask", instrumented("ask", ask_command)))
+        application.add_handler(CommandHandler("search", instrumented("search", search_command)))
+        application.add_handler(CommandHandler("image", instrumented("image", image_command)))
+        application.add_handler(CommandHandler("quota", instrumented("quota", quota_command)))
+        application.add_handler(CommandHandler("cancel", instrumented("cancel", cancel_command)))
+        application.add_handler(CommandHandler("resetquota", instrumented("resetquota", resetquota_cmd)))
+        application.add_handler(CommandHandler("setlimit", instrumented("setlimit", setlimit_cmd)))
+        application.add_handler(CommandHandler("resetmonth", instrumented("resetmonth", resetmonth_cmd)))
+        application.add_handler(CommandHandler("checkquota", instrumented("checkquota", checkquota_cmd)))
+        application.add_handler(CommandHandler("stats", instrumented("stats", stats_cmd)))
+        application.add_handler(CommandHandler("compactstats", instrumented("compactstats", compactstats_cmd)))
+
+        # Add lifecycle hooks to application
+        application.post_init = post_init
+        application.post_stop = post_stop
+        application.post_shutdown = post_shutdown
+        _application = application
+        logger.info("Telegram application built in %.0fms", (time.perf_counter() - t0) * 1000)
+    return _application
+
+# Set bot commands (menu) — in the background, so the first update after a
+# cold start does not wait for this round trip.
+async def _set_menu(bot):
+    from telegram import BotCommand
+    try:
+        await bot.set_my_commands([
+            BotCommand("help", "Show help & commands"),
+            BotCommand("ask", "Ask a question to the AI"),
+            BotCommand("search", "Safe math or Google search"),
+            BotCommand("image", "Generate AI image (10/day default)"),
+            BotCommand("quota", "Show today's image usage"),
+            BotCommand("cancel", "Cancel your queued image"),
+        ])
+    except Exception as e:
+        logger.warning("set_my_commands failed: %s", e)
+
 async def post_init(apply):
-    await apply.bot.set_my_commands([
-        BotCommand("help", "Show help & commands"),
-        BotCommand("ask", "Ask a question to the AI"),
-        BotCommand("search", "Safe math or Google search"),
-        BotCommand("image", "Generate AI image (10/day default)"),
-        BotCommand("quota", "Show today's image usage"),
-    ])
-
-# Add post_init to application
-application.post_init = post_init
-
-# Health endpoint
-@app.get("/")
-def health():
-    return "ok"
-
-# Webhook endpoint for Telegram updates — Vercel will POST here
-@app.route(f"/{BOT_SECRET}", methods=["POST"])
-def webhook():
-    update_data = flask_request.get_json(force=True, silent=True)
+    quota_cache.start()
+    task = asyncio.get_running_loop().create_task(_set_menu(apply.bot))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def post_stop(apply):
+    # polling mode: the bot is still usable here, so send what is queued
+    await outbox.drain()
+
+async def post_shutdown(apply):
+    await quota_cache.stop()
+    await quota_store.close()
+    await close_http_clients()
+
+# ------------- Webhook ingestion: bounded, per-chat ordered update workers -------------
+class UpdateDispatcher:
+    """Feeds webhook updates to application.process_update with bounded concurrency.
+
+    Every chat gets its own FIFO drained by one task, so updates from one chat
+    are handled in arrival order while other chats never wait behind a slow
+    /image; at most `concurrency` updates run at once. submit() never waits:
+    once `max_pending` updates are queued or running it returns "busy" so the
+    webhook can answer 503 and Telegram retries later. Accepted update_ids are
+    remembered so those retries are not processed twice.
+    """
+
+    def __init__(self, concurrency: int, max_pending: int, dedup_size: int):
+        self.concurrency = max(1, concurrency)
+        self.max_pending = max_pending
+        self.dedup_size = dedup_size
+        self._chats = {}            # chat key -> deque of updates
+        self._tasks = set()
+        self._slots = None
+        self._pending = 0
+        self._seen = OrderedDict()
+        self._app = None
+        self.on_done = None         # callback(update) once an update has been handled (sharded workers ack)
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected = 0
+
+    @property
+    def running(self):
+        return self._slots is not None
+
+    def stats(self):
+        return {"pending": self._pending, "chats": len(self._chats), "accepted": self.accepted,
+                "duplicates": self.duplicates, "rejected": self.rejected}
+
+    async def start(self, app):
+        if self.running:
+            return
+        self._app = app
+        await app.initialize()
+        if app.post_init:
+            await app.post_init(app)
+        self._slots = asyncio.Semaphore(self.concurrency)
+        logger.info("Update dispatcher started (concurrency %d)", self.concurrency)
+
+    async def _drain(self, key, chat_queue):
+        try:
+            while chat_queue:
+                update = chat_queue[0]
+                async with self._slots:
+                    try:
+                        await self._app.process_update(update)
+                    except Exception as e:
+                        logger.exception("Processing update %s failed: %s", update.update_id, e)
+                if self.on_done is not None:
+                    self.on_done(update)
+                chat_queue.popleft()
+                self._pending -= 1
+        finally:
+            if self._chats.get(key) is chat_queue:
+                del self._chats[key]
+
+    def submit(self, update):
+        """Queue an update; returns "ok", "duplicate" or "busy"."""
+        if update.update_id in self._seen:
+            self.duplicates += 1
+            return "duplicate"
+        if self._pending >= self.max_pending:
+            self.rejected += 1
+            return "busy"
+        chat = update.effective_chat
+        key = chat.id if chat else ("update", update.update_id)
+        chat_queue = self._chats.get(key)
+        if chat_queue is None:
+            chat_queue = self._chats[key] = deque([update])
+            task = asyncio.get_running_loop().create_task(self._drain(key, chat_queue))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        else:
+            chat_queue.append(update)
+        self._pending += 1
+        self._seen[update.update_id] = None
+        if len(self._seen) > self.dedup_size:
+            self._seen.popitem(last=False)
+        self.accepted += 1
+        return "ok"
+
+    async def stop(self):
+        """Finish queued updates and shut the application down."""
+        if not self.running:
+            return
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+        await outbox.drain()
+        self._slots = None
+        if self._app.post_shutdown:
+            await self._app.post_shutdown(self._app)
+        await self._app.shutdown()
+
+dispatcher = UpdateDispatcher(WEBHOOK_CONCURRENCY, WEBHOOK_MAX_PENDING, WEBHOOK_DEDUP_SIZE)
+_dispatcher_lock = asyncio.Lock()
+
+async def ingest_update(update_data: dict):
+    """Parse a webhook payload and hand it to the dispatcher (starting it on first use)."""
+    if not dispatcher.running:
+        async with _dispatcher_lock:
+            await dispatcher.start(get_application())
+    from telegram import Update
+    return dispatcher.submit(Update.de_json(update_data, get_application().bot))
+
+# Flask (WSGI) runs handlers on a dedicated event-loop thread so a slow /image
+# never blocks the WSGI worker; the request only waits for parse + enqueue.
+_bot_loop = None
+_bot_loop_guard = threading.Lock()
+
+def _run_on_bot_loop(coro, timeout: float = 10):
+    global _bot_loop
+    with _bot_loop_guard:
+        if _bot_loop is None:
+            _bot_loop = asyncio.new_event_loop()
+            threading.Thread(target=_bot_loop.run_forever, name="bot-loop", daemon=True).start()
+    return asyncio.run_coroutine_threadsafe(coro, _bot_loop).result(timeout)
+
+def get_flask_app():
+    global _flask_app
+    if _flask_app is None:
+        from flask import Flask, request as flask_request
+
+        app = Flask(__name__)
+
+        # Health endpoint
+        @app.get("/")
+        def health():
+            return "ok"
+
+        # Prometheus scrape endpoint
+        @app.get("/metrics")
+        def metrics():
+            body, content_type = metrics_payload()
+            return body, 200, {"Content-Type": content_type}
+
+        # Webhook endpoint for Telegram updates — Vercel will POST here
+        @app.route(f"/{BOT_SECRET}", methods=["POST"])
+        def webhook():
+            update_data = flask_request.get_json(force=True, silent=True)
+            if not update_data:
+                return "no data", 400
+            if _run_on_bot_loop(ingest_update(update_data)) == "busy":
+                return "busy", 503
+            return "ok"
+
+        _flask_app = app
+    return _flask_app
+
+# ASGI webhook mode: uvicorn bot_pro:asgi_app
+async def _asgi_reply(send, status: int, body: bytes, content_type: str = "text/plain"):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type.encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+async def asgi_app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                async with _dispatcher_lock:
+                    await dispatcher.start(get_application())
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await dispatcher.stop()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+    path, method = scope["path"], scope["method"]
+    if method == "GET" and path == "/":
+        return await _asgi_reply(send, 200, b"ok")
+    if method == "GET" and path == "/metrics":
+        body, content_type = metrics_payload()
+        return await _asgi_reply(send, 200, body, content_type)
+    if method != "POST" or path != f"/{BOT_SECRET}":
+        return await _asgi_reply(send, 404, b"not found")
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    try:
+        update_data = json.loads(body or b"null")
+    except ValueError:
+        update_data = None
     if not update_data:
-        return "no data", 400
-    update_obj = Update.de_json(update_data, application.bot)
-    application.update_queue.put_nowait(update_obj)
-    return "ok"
+        return await _asgi_reply(send, 400, b"no data")
+    if await ingest_update(update_data) == "busy":
+        return await _asgi_reply(send, 503, b"busy")
+    await _asgi_reply(send, 200, b"ok")
+
+# ------------- Sharded polling: fetcher + supervised worker processes -------------
+_shard_index = None     # set inside a worker process
+def _update_chat_id(data: dict):
+    """Chat id of a raw Bot API update (sender id when it has no chat), or None."""
+    for value in data.values():
+        if isinstance(value, dict):
+            chat = value.get("chat") or (value.get("message") or {}).get("chat")
+            if chat:
+                return chat.get("id")
+            if value.get("from"):
+                return value["from"].get("id")
+    return None
+
+def _shard_worker(index: int, inbox, acks):
+    """Worker process entry point."""
+    global _shard_index
+    _shard_index = index
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # Ctrl+C reaches the whole group; the supervisor drains us
+    # per-user and global limits are shared by all workers; per-chat Telegram
+    # limits stay local since a chat always lands on the same worker
+    rate_limiter.share(SHARD_STATE_DB, local=("tg_chat", "tg_group"))
+    # daily limits and the monthly cap are read and written by every worker
+    quota_cache.shared = ("limits", "usage_images")
+    quota_cache.on_invalidate = lambda prefix, drop_pending: acks.put((index, ("invalidate", prefix, drop_pending)))
+    asyncio.run(_shard_worker_main(index, inbox, acks))
+
+async def _shard_worker_main(index: int, inbox, acks):
+    from telegram import Update
+    loop = asyncio.get_running_loop()
+    app = get_application()
+    dispatcher.on_done = lambda update: acks.put((index, update.update_id))
+    await dispatcher.start(app)
+    logger.info("Shard worker %d ready (pid %d)", index, os.getpid())
+    while True:
+        data = await loop.run_in_executor(None, inbox.get)
+        if data is None:
+            break
+        if "invalidate" in data:   # an admin command on another worker reset quota paths
+            prefix, drop_pending = data["invalidate"]
+            quota_cache.invalidate(prefix, drop_pending, announce=False)
+            continue
+        update = Update.de_json(data, app.bot)
+        while True:
+            result = dispatcher.submit(update)
+            if result != "busy":
+                break
+            await asyncio.sleep(0.05)
+        if result == "duplicate":
+            acks.put((index, update.update_id))
+    await dispatcher.stop()
+    logger.info("Shard worker %d drained", index)
+
+class ShardSupervisor:
+    """Multi-process polling for self-hosted runs (POLL_WORKERS > 1).
+
+    This process long-polls getUpdates and routes every update to worker
+    `chat_id % n`, so a chat always lands on the same worker and that
+    worker's UpdateDispatcher keeps its updates in order. Workers are
+    spawned processes running the normal Application; quota goes through the
+    shared quota store (SQLite file or Firebase), with daily limits and the
+    monthly cap read and written past each worker's QuotaCache and admin
+    invalidations forwarded to every worker, and rate limits through
+    SharedTokenBuckets in SHARD_STATE_DB.
+
+    Every fetched batch is written to `state_db` before the next getUpdates
+    call confirms it to Telegram, and a row is deleted once its worker acks
+    it, so the table always holds what was taken from Telegram but not yet
+    handled. On start those rows are routed again (at-least-once: an update
+    whose ack was still in flight can run twice). If a worker dies, it is
+    restarted (with backoff when it keeps crashing) and gets its unacked
+    updates again. getUpdates pauses while `max_inflight` updates are
+    unacked. On SIGINT/SIGTERM fetching stops and workers finish their
+    queues (up to `drain_timeout`); what is left waits in `state_db`.
+    """
+
+    def __init__(self, n: int, max_inflight: int, drain_timeout: float, state_db: str):
+        import multiprocessing
+        self.n = n
+        self.max_inflight = max_inflight
+        self.drain_timeout = drain_timeout
+        self._bot = (TELEGRAM_TOKEN or "").split(":", 1)[0]
+        self._db = sqlite3.connect(state_db, check_same_thread=False, timeout=SQLITE_BUSY_TIMEOUT)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS shard_updates (bot TEXT, update_id INTEGER, data TEXT, "
+                         "PRIMARY KEY (bot, update_id)) WITHOUT ROWID")
+        self._db.execute("CREATE TABLE IF NOT EXISTS shard_offsets (bot TEXT PRIMARY KEY, next_offset INTEGER)")
+        self._db.commit()
+        self._db_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="shard-state")
+        self._ctx = multiprocessing.get_context("spawn")
+        self._acks = self._ctx.Queue()
+        self._workers = [None] * n                      # (process, inbox or None while down, started_at)
+        self._inflight = [OrderedDict() for _ in range(n)]   # update_id -> raw update
+        self._crashes = [0] * n
+        self._restart_at = [0.0] * n
+        self._stopping = False
+        self._fetch_task = None
+        self.offset = None
+        self.routed = 0
+        self.restarts = 0
+        self.redelivered = 0
+        self.replayed = 0
+
+    def stats(self):
+        return {"workers": sum(1 for w in self._workers if w and w[0].is_alive()), "routed": self.routed,
+                "inflight": sum(len(f) for f in self._inflight), "restarts": self.restarts,
+                "redelivered": self.redelivered, "replayed": self.replayed}
+
+    async def _state(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._db_executor, fn, *args)
+
+    def _save(self, updates):
+        """Blocking: record a fetched batch before the next getUpdates confirms it."""
+        with self._db:
+            self._db.executemany("INSERT OR REPLACE INTO shard_updates VALUES (?, ?, ?)",
+                                 [(self._bot, u["update_id"], json.dumps(u)) for u in updates])
+            self._db.execute("INSERT OR REPLACE INTO shard_offsets VALUES (?, ?)",
+                             (self._bot, updates[-1]["update_id"] + 1))
+
+    def _forget(self, update_ids):
+        with self._db:
+            self._db.executemany("DELETE FROM shard_updates WHERE bot = ? AND update_id = ?",
+                                 [(self._bot, uid) for uid in update_ids])
+
+    def _load(self):
+        rows = self._db.execute("SELECT data FROM shard_updates WHERE bot = ? ORDER BY update_id",
+                                (self._bot,)).fetchall()
+        offset = self._db.execute("SELECT next_offset FROM shard_offsets WHERE bot = ?", (self._bot,)).fetchone()
+        return [json.loads(data) for (data,) in rows], offset[0] if offset else None
+
+    def _spawn(self, i: int):
+        inbox = self._ctx.Queue()   # fresh queue: a killed process may leave the old one locked
+        proc = self._ctx.Process(target=_shard_worker, args=(i, inbox, self._acks), name=f"shard-{i}", daemon=True)
+        proc.start()
+        self._workers[i] = (proc, inbox, time.monotonic())
+        for data in self._inflight[i].values():
+            inbox.put(data)
+            self.redelivered += 1
+
+    def _route(self, data: dict):
+        key = _update_chat_id(data)
+        i = (data["update_id"] if key is None else key) % self.n
+        if data["update_id"] in self._inflight[i]:
+            return
+        self._inflight[i][data["update_id"]] = data
+        inbox = self._workers[i][1]
+        if inbox is not None:       # else the replacement worker gets it with the other unfinished ones
+            inbox.put(data)
+        self.routed += 1
+
+    async def _collect_acks(self):
+        done = []
+        while True:
+            try:
+                i, update_id = self._acks.get_nowait()
+            except queue.Empty:
+                break
+            if isinstance(update_id, tuple):   # ("invalidate", prefix, drop_pending): pass on to the others
+                for j, (_, inbox, _) in enumerate(self._workers):
+                    if j != i and inbox is not None:
+                        inbox.put({"invalidate": list(update_id[1:])})
+                continue
+            if self._inflight[i].pop(update_id, None) is not None:
+                done.append(update_id)
+        if done:
+            try:
+                await self._state(self._forget, done)
+            except sqlite3.Error as e:
+                logger.warning("Could not clear %d finished updates (they may run again after a restart): %s",
+                               len(done), e)
+
+    def _check_workers(self):
+        now = time.monotonic()
+        for i, (proc, inbox, started) in enumerate(self._workers):
+            if proc.is_alive():
+                continue
+            if not self._restart_at[i]:
+                # a worker that dies within a minute of starting counts towards the backoff
+                self._crashes[i] = self._crashes[i] + 1 if now - started < 60 else 1
+                delay = min(30.0, 0.5 * 2 ** (self._crashes[i] - 1))
+                self._restart_at[i] = now + delay
+                logger.error("Shard worker %d exited (code %s), %d unfinished updates; restarting in %.1fs",
+                             i, proc.exitcode, len(self._inflight[i]), delay)
+                self._workers[i] = (proc, None, started)
+            if now >= self._restart_at[i]:
+                self._restart_at[i] = 0.0
+                self.restarts += 1
+                self._spawn(i)
+
+    async def _telegram(self, method: str, http_timeout: float = 10, **params):
+        url = f"{TELEGRAM_API_BASE}/bot{TELEGRAM_TOKEN}/{method}"
+        params = {k: v for k, v in params.items() if v is not None}
+        resp = await _async_post(url, service="telegram", json=params, timeout=http_timeout)
+        return resp.json()
+
+    async def _fetch(self):
+        await self._telegram("deleteWebhook")
+        while not self._stopping:
+            if sum(len(f) for f in self._inflight) >= self.max_inflight:
+                await asyncio.sleep(0.05)
+                continue
+            try:
+                data = await self._telegram("getUpdates", http_timeout=POLL_TIMEOUT + 10,
+                                            offset=self.offset, timeout=POLL_TIMEOUT)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("getUpdates failed: %s", e)
+                await asyncio.sleep(1)
+                continue
+            if not data.get("ok"):
+                retry_after = (data.get("parameters") or {}).get("retry_after", 1)
+                logger.warning("getUpdates error: %s", data.get("description"))
+                await asyncio.sleep(retry_after)
+                continue
+            updates = data.get("result") or []
+            if not updates:
+                continue
+            try:
+                await self._state(self._save, updates)
+            except sqlite3.Error as e:
+                # not confirmed yet, so the next getUpdates returns the same batch
+                logger.warning("Could not record fetched updates, fetching again: %s", e)
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                self.offset = update["update_id"] + 1
+                self._route(update)
+
+    def stop(self):
+        if not self._stopping:
+            logger.info("Sharded polling: stopping, draining workers")
+            self._stopping = True
+            if self._fetch_task is not None:
+                self._fetch_task.cancel()
+
+    async def _drain(self):
+        for proc, inbox, _ in self._workers:
+            if proc.is_alive():
+                inbox.put(None)
+        deadline = time.monotonic() + self.drain_timeout
+        while any(w[0].is_alive() for w in self._workers) and time.monotonic() < deadline:
+            await self._collect_acks()
+            await asyncio.sleep(0.05)
+        await self._collect_acks()
+        for proc, _, _ in self._workers:
+            if proc.is_alive():
+                logger.warning("Shard worker %s did not drain in time, terminating", proc.name)
+                proc.terminate()
+                proc.join(5)
+        unfinished = sum(len(f) for f in self._inflight)
+        if unfinished:
+            logger.warning("%d updates unfinished; they run again on the next start", unfinished)
+        if self.offset is not None:   # everything fetched is recorded, so confirm it all
+            with contextlib.suppress(Exception):
+                await self._telegram("getUpdates", offset=self.offset, limit=1, timeout=0)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+        for i in range(self.n):
+            self._spawn(i)
+        pending, self.offset = await self._state(self._load)
+        for data in pending:
+            self._route(data)
+        self.replayed = len(pending)
+        logger.info("Sharded polling: %d workers, %d unfinished updates from the last run", self.n, len(pending))
+        self._fetch_task = loop.create_task(self._fetch())
+        while not self._stopping:
+            if self._fetch_task.done() and not self._fetch_task.cancelled() and self._fetch_task.exception():
+                logger.error("Fetcher failed: %s", self._fetch_task.exception())
+                self.stop()
+                break
+            await self._collect_acks()
+            self._check_workers()
+            await asyncio.sleep(0.05)
+        with contextlib.suppress(asyncio.CancelledError):
+            await self._fetch_task
+        await self._drain()
+        await close_http_clients()
+        await self._state(self._db.close)
+        self._db_executor.shutdown()
+        logger.info("Sharded polling stopped: %s", self.stats())
+
+def __getattr__(name):
+    # `bot_pro.app` (Vercel / WSGI servers) and `bot_pro.application` stay importable names.
+    if name == "app":
+        return get_flask_app()
+    if name == "application":
+        return get_application()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def __dir__():
+    # Vercel's runtime looks for `app` in dir(module)
+    return sorted(set(globals()) | {"app", "application"})
+
+if not LAZY_STARTUP:
+    import numexpr  # noqa: F401
+    get_application()
+    get_flask_app()
 
-# Local run (for testing)
+# Local run (for testing); POLL_WORKERS > 1 = sharded multi-process polling
 if __name__ == "__main__":
-    logger.info("Running bot in polling mode (local).")
-    application.run_polling()
+    if POLL_WORKERS > 1:
+        asyncio.run(ShardSupervisor(POLL_WORKERS, SHARD_MAX_INFLIGHT, SHARD_DRAIN_TIMEOUT, SHARD_STATE_DB).run())
+    else:
+        logger.info("Running bot in polling mode (local).")
+        get_application().run_polling()